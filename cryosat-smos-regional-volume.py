@@ -4,25 +4,39 @@
 # Regional mask from  ftp://ftp.awi.de/sea_ice/product/cryosat2/v2p5/nh/l3c_grid/isoweek/
 
 import numpy as np
-from netCDF4 import Dataset
+from netCDF4 import Dataset, default_fillvals
 from datetime import date, datetime, timedelta
 import glob
+import itertools
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 import csv
 import sys
 import os
 import shutil
 import urllib.request
 from contextlib import closing
+from calendar import isleap
 from math import sqrt, sin, cos, pi, floor, isnan
+import matplotlib
+matplotlib.use('Agg') # charts are drawn in task worker threads, which GUI backends do not support
 from matplotlib.colors import LinearSegmentedColormap
 import matplotlib.pyplot as plt
 from decouple import config
 
-import time
+import threading
 import dropbox_client
 import upload_to_google_drive
 import regional_python_graphs
 import make_animation
+import map_tiles
+import task_graph
+import upload_queue
+import custom_regions
+import season_statistics
+import derived_series
+import products
+import process_pool
 import get_last_saved_day
 
 thresh = 15.            # Concentration threshold for area/extent (%)
@@ -30,10 +44,20 @@ sic_unc = 0.05          # Default concentration uncertainty
 grid_spacing_km = 25.   # Default EASE grid spacing
 monthNames = ['Jan','Feb','Mar','Apr','May','Jun','Jul','Aug','Sep','Oct','Nov','Dec']
 monthLengths = [31,28,31,30,31,30,31,31,30,31,30,31]
-ftpFolder = 'ftp://ftp.awi.de/sea_ice/product/cryosat2_smos/v206/nh/'
-ftpFolderNew = 'ftp://ftp.awi.de/sea_ice/product/cryosat2_smos/v300/nh/'
 
 putOnDropbox = True
+writeMapTiles = True
+customRegionFileName = 'cryosat-smos-custom-region-volume.csv'
+customRegionBackfill = None # (startDate, endDate) to recompute the custom region volumes over the archive
+changeMapDays = 7 # daily thickness change maps of the last days, plus one weekly change map
+decodeFloat32 = True # read netCDF variables unmasked as float32 (float64 variables as float64) with NaN for missing values, into per-thread buffers reused across days
+saveThicknessHistograms = True # area and volume per region and thickness class, one file per day in data/thickness-histograms/, published to Dropbox
+seasonAnimation = None # (startDate, endDate) to animate the thickness and anomaly maps of a whole season, e.g. (datetime(2024,10,15), datetime(2025,4,15))
+seasonAnimationFields = ['thickness', 'anomaly']
+productComparison = None # (['v206', 'v300'], startDate, endDate) to compute the regional volumes of several products side by side
+
+custom_regions.registerLatitudeBand('north-of-80n', 80, 90)
+custom_regions.registerPolygon('fram-strait-export', [(81, -20), (81, 10), (79, 10), (79, -20)])
 
 class RegionCode: 		# Region codes used in CryoSat auxiliary data
 	cab = 1
@@ -95,49 +119,243 @@ def padzeros(n):
     """
 	return str(n) if n >= 10 else '0'+str(n)
 
-def usesNewVersion(date):
-	return date > datetime(2025,1,1)
+def getFileName(date, product = None):
+	product = product or products.getProduct(date)
+	return product.getFileName(date)
+	
+def getFileLock(path):
+	with fileLocksLock:
+		return fileLocks.setdefault(path, threading.Lock())
 
-def usesLatestFolder(date):
-	return date > datetime(2025,9,1)
+def getBuffer(name, shape, dtype = np.float32):
+	"""
+	Work array of this thread, allocated once and reused for every following day.
+    """
+	buffers = decodeBuffers.__dict__.setdefault('buffers', {})
+	key = (name, shape, np.dtype(dtype).str)
+	if key not in buffers:
+		buffers[key] = np.empty(shape, dtype=dtype)
+	return buffers[key]
 
-def getFileName(date):
-	startDate = date - timedelta(days = 3)
-	endDate = date + timedelta(days = 3)
-	datestring = str(startDate.year) + padzeros(startDate.month) + padzeros(startDate.day)+ '_' + str(endDate.year) + padzeros(endDate.month) + padzeros(endDate.day) + '_' + ('r' if not usesLatestFolder(date) else 'o')
-	if(usesNewVersion(date)):
-		return 'W_XX-ESA,SMOS_CS2_S3A_S3B,NH_12P5KM_EASE2_' + datestring + '_v300_01_l4sit.nc'
-	return 'W_XX-ESA,SMOS_CS2,NH_25KM_EASE2_' + datestring + '_v206_01_l4sit.nc'
-	#ftp://ftp.awi.de/sea_ice/product/cryosat2_smos/v300/nh/W_XX-ESA,SMOS_CS2_S3A_S3B,NH_12P5KM_EASE2_20251015_20251021_o_v300_01_l4sit
-	
-def getGriddedThickness(date):
-	filename = 'data/LATEST/' + getFileName(date)
-	if not os.path.isfile(filename):
-		filename = download(date)
-	f = Dataset(filename, 'r', format="NETCDF4")
-	thicknessData = f.variables[('analysis_' if not usesNewVersion(date) else '') + 'sea_ice_thickness'][:]
-	f.close()
+packingAttributes = ('scale_factor', 'add_offset')
+
+def getDecodeType(variable):
+	"""
+	Type a netCDF variable is decoded to: float32, or float64 for variables stored (or, for packed variables, scaled)
+	with more precision and always float64 without decodeFloat32, so that decoding never rounds the stored values.
+    """
+	if not decodeFloat32:
+		return np.float64
+	attributes = variable.ncattrs()
+	dtypes = [np.asarray(variable.getncattr(attribute)).dtype for attribute in packingAttributes if attribute in attributes]
+	if not dtypes or np.dtype(variable.dtype).kind == 'f':
+		dtypes.append(np.dtype(variable.dtype))
+	return np.float64 if max(dtype.itemsize for dtype in dtypes) > 4 else np.float32
+
+def getMissingMask(variable, data):
+	"""
+	Cells netCDF4 would mask, from the stored (packed) values and attributes: missing values, the fill value (or the
+	default fill value of the type) and values outside the valid range.
+    """
+	attributes = variable.ncattrs()
+	missingValues = list(np.atleast_1d(variable.getncattr('missing_value'))) if 'missing_value' in attributes else []
+	if '_FillValue' in attributes:
+		missingValues.append(variable.getncattr('_FillValue'))
+	elif data.dtype.str[1:] not in ('u1', 'i1'): # as netCDF4: the default fill value, except for bytes
+		missingValues.append(default_fillvals[data.dtype.str[1:]])
+	if 'valid_range' in attributes:
+		validMin, validMax = variable.getncattr('valid_range')
+	else:
+		validMin = variable.getncattr('valid_min') if 'valid_min' in attributes else None
+		validMax = variable.getncattr('valid_max') if 'valid_max' in attributes else None
+	isMissing = getBuffer('isMissing', data.shape, bool)
+	term = getBuffer('isMissingTerm', data.shape, bool)
+	isMissing[...] = False
+	for value in missingValues:
+		if data.dtype.kind == 'f' and np.isnan(value):
+			isMissing |= np.isnan(data, out=term)
+		else:
+			isMissing |= np.equal(data, np.array(value, data.dtype), out=term)
+	if validMin is not None:
+		isMissing |= np.less(data, np.array(validMin, data.dtype), out=term)
+	if validMax is not None:
+		isMissing |= np.greater(data, np.array(validMax, data.dtype), out=term)
+	return isMissing
+
+def readVariable(f, name, bufferName = None):
+	"""
+	Read a netCDF variable as a plain array with NaN where there is no data.
+	With decodeFloat32, auto-masking and scaling are off: the stored values netCDF4 would mask are found in packed
+	units, the values are unpacked (scale_factor, add_offset) into float32 (see getDecodeType) and the masked cells
+	set to NaN. netCDF4 cannot read into an existing array, so with bufferName the data is copied into that (reused)
+	buffer of this thread.
+    """
+	variable = f.variables[name]
+	if not decodeFloat32:
+		return np.ma.filled(variable[:].astype(float), np.nan)
+	variable.set_auto_maskandscale(False)
+	data = variable[:]
+	isMissing = getMissingMask(variable, data)
+	dtype = getDecodeType(variable)
+	if bufferName is None:
+		out = data if data.dtype == dtype else data.astype(dtype)
+	else:
+		out = getBuffer(bufferName, data.shape, dtype)
+		np.copyto(out, data, casting='unsafe')
+	attributes = variable.ncattrs()
+	if 'scale_factor' in attributes:
+		out *= variable.getncattr('scale_factor')
+	if 'add_offset' in attributes:
+		out += variable.getncattr('add_offset')
+	out[isMissing] = np.nan
+	return out
+
+def getGriddedThickness(date, product = None):
+	product = product or products.getProduct(date)
+	filename = product.getLocalFileName(date)
+	with getFileLock(filename):
+		if not os.path.isfile(filename):
+			filename = download(date, product)
+	with datasetLock: # the netCDF/HDF5 library is not thread-safe
+		f = Dataset(filename, 'r', format="NETCDF4")
+		thicknessData = readVariable(f, product.thicknessVariable)
+		f.close()
 	return thicknessData
 
-def download(date):
+def download(date, product = None):
 	"""
 	Download Cryosat-SMOS ftp file. 
     """
 	print('inside download ' + str(date.year) + padzeros(date.month) + padzeros(date.day))
-	filename = getFileName(date)
-	downloadFilename = filename
-	if date.year == 2025 and date.month == 3 and date.day == 25:
-		downloadFilename = getFileName(datetime(date.year, date.month, date.day-1))
-	downloadFilename = downloadFilename.replace(',','%2C')
-	ftpSubfolder = (str(date.year) + "/" + padzeros(date.month) + '/') if not usesLatestFolder(date) else 'LATEST/' 
-	fullFtpPath = (ftpFolder if not usesNewVersion(date) else ftpFolderNew) + ftpSubfolder + downloadFilename
-	localpath = 'data/LATEST/' + filename
+	product = product or products.getProduct(date)
+	fullFtpPath = product.getFtpPath(date)
+	localpath = product.getLocalFileName(date)
 	print('downloading file ', fullFtpPath, localpath)
 	with closing(urllib.request.urlopen(fullFtpPath)) as r:
-		with open(localpath, 'wb') as f:
+		with open(localpath + '.part', 'wb') as f:
 			shutil.copyfileobj(r, f)
+	os.replace(localpath + '.part', localpath) # never leave a partial file under the final name
 	return localpath	
 		
+def getCustomRegionIndex(grid):
+	return grid.getCached('customRegions', lambda: custom_regions.compileRegions(grid.getLatitude(), grid.getLongitude(), grid.gridSpacingKm))
+
+def readPerGridCellVolume(filename, product):
+	"""
+	Read the volume per grid cell (km³, NaN where there is no data) from a daily gridded thickness file. 
+    """
+	with datasetLock:
+		f = Dataset(filename, 'r', format="NETCDF4")
+		sic = readVariable(f, product.concentrationVariable).squeeze()
+		sit = readVariable(f, product.thicknessVariable).squeeze()
+		f.close()
+	return (sic/100.) * sit * product.grid.cellArea / 1000.0
+
+def getCustomRegionRows(filenames, product):
+	"""
+	Custom region volumes for a list of daily files, evaluated for all days and regions in one batched reduction. 
+    """
+	if not filenames or not custom_regions.regions:
+		return []
+	index = getCustomRegionIndex(product.grid)
+	volumes = index.evaluateStack(np.stack([readPerGridCellVolume(filename, product) for filename in filenames]))
+	rows = []
+	for filename, regionVolumes in zip(filenames, volumes):
+		rows.append(list(product.getDates(filename)) + [rounded(v) for v in regionVolumes])
+	return rows
+
+def appendCustomRegionRows(rows, overwrite = False):
+	header = ['start', 'end'] + custom_regions.getRegionNames()
+	if os.path.isfile(customRegionFileName) and not overwrite:
+		with open(customRegionFileName, 'r') as f:
+			existingHeader = f.readline().strip().split(',')
+		if existingHeader != header:
+			print('custom regions changed, starting a new', customRegionFileName, '(use customRegionBackfill to fill the archive)')
+			os.replace(customRegionFileName, customRegionFileName + '.bak')
+	writeHeader = overwrite or not os.path.isfile(customRegionFileName)
+	with open(customRegionFileName, 'w' if overwrite else 'a', newline='') as outFile:
+		csvFile = csv.writer(outFile)
+		if writeHeader:
+			csvFile.writerow(header)
+		csvFile.writerows(rows)
+
+def backfillCustomRegions(startDate, endDate, chunk = 30):
+	"""
+	Recompute the custom region volumes for every day of the winter seasons between startDate and endDate. 
+    """
+	rows = []
+	filenames = []
+	chunkProduct = products.getProduct(startDate)
+	date = startDate
+	while date <= endDate:
+		product = products.getProduct(date)
+		if filenames and (product != chunkProduct or len(filenames) == chunk):
+			rows += getCustomRegionRows(filenames, chunkProduct)
+			filenames = []
+		chunkProduct = product
+		if 5 <= date.month <= 9: # no CryoSat-SMOS data in summer
+			date = date + timedelta(days = 1)
+			continue
+		localFileName = product.getLocalFileName(date)
+		try:
+			with getFileLock(localFileName):
+				if not os.path.isfile(localFileName):
+					download(date, product)
+			filenames.append(localFileName)
+		except:
+			print('File not found: ', date)
+		date = date + timedelta(days = 1)
+	rows += getCustomRegionRows(filenames, chunkProduct)
+	appendCustomRegionRows(rows, overwrite = True)
+
+def downloadIfMissing(date, product):
+	localFileName = product.getLocalFileName(date)
+	with getFileLock(localFileName):
+		if not os.path.isfile(localFileName):
+			try:
+				download(date, product)
+			except Exception as e:
+				print('File not found: ', product.name, date, e)
+				return None
+	return localFileName
+
+def dayvolByName(filename, productName):
+	return dayvol(filename, products.getProductByName(productName)) # the product name is cheaper to send to a worker than the product and its grid
+
+def processProducts(productNames, startDate, endDate, workers = 4):
+	"""
+	Compute the regional volumes of several products side by side, e.g. v206 and v300 over their overlap period.
+	Each product gets its own CSV. Downloads run concurrently and each file is downloaded once; the static grids,
+	region indexes and projection caches are computed once per grid before the worker processes are forked.
+    """
+	productList = [products.getProductByName(name) for name in productNames]
+	dates = []
+	date = startDate
+	while date <= endDate:
+		dates.append(date)
+		date = date + timedelta(days = 1)
+
+	jobs = [(product, date) for product in productList for date in dates]
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		localFileNames = list(executor.map(lambda job: downloadIfMissing(job[1], job[0]), jobs))
+
+	for grid in set(product.grid for product in productList):
+		getRegionIndex(grid)
+
+	filesByProduct = {product.name: [] for product in productList}
+	for (product, date), localFileName in zip(jobs, localFileNames):
+		if localFileName is not None:
+			filesByProduct[product.name].append(localFileName)
+	with process_pool.getProcessPool(workers) as executor:
+		results = {name: executor.map(dayvolByName, filenames, [name]*len(filenames)) for name, filenames in filesByProduct.items()}
+		for name, rows in results.items():
+			outputFileName = 'cryosat-smos-regional-volume' + products.getProductByName(name).getOutputSuffix() + '.csv'
+			with open(outputFileName, 'w', newline='') as outFile:
+				csvFile = csv.writer(outFile)
+				csvFile.writerow(['start', 'end'] + list(season_statistics.regionColumns) + ['uncertainty'])
+				csvFile.writerows(rows)
+			print('written', outputFileName)
+
 def getLatestDate(csvFileName):
 	lastSavedStartDay,lastSavedEndDay = get_last_saved_day.getLastSavedDay(csvFileName)
 	lastSavedEndDayString = str(lastSavedEndDay)
@@ -150,6 +368,20 @@ def downloadNewFiles():
 	csvFileName = 'cryosat-smos-regional-volume.csv'	
 	
 	dropbox_client.downloadFromDropbox([csvFileName])
+	if not os.path.isfile(season_statistics.statisticsFileName): # not restored from the cache of the previous run
+		try:
+			dropbox_client.downloadFromDropbox([season_statistics.statisticsFileName])
+		except Exception as e:
+			print('no season statistics on Dropbox, rebuilding them from the CSV', e)
+			if os.path.isfile(season_statistics.statisticsFileName) and os.path.getsize(season_statistics.statisticsFileName) == 0:
+				os.remove(season_statistics.statisticsFileName)
+	if custom_regions.regions:
+		try:
+			dropbox_client.downloadFromDropbox([customRegionFileName])
+		except Exception as e:
+			print('no custom region volumes on Dropbox yet, starting', customRegionFileName, e)
+			if os.path.isfile(customRegionFileName) and os.path.getsize(customRegionFileName) == 0:
+				os.remove(customRegionFileName) # left empty by the failed download
 	
 	latestDate = getLatestDate(csvFileName)
 	
@@ -157,18 +389,26 @@ def downloadNewFiles():
 	outFile = open(csvFileName, 'a', newline='')
 	csvFile = csv.writer(outFile)
 	found = False
+	newFiles = []
 	while date < dayBeforeYesterday:
 		print('downloading', date, dayBeforeYesterday)
 		filename = ''
+		product = products.getProduct(date - timedelta(days = 3))
 		try:
-			filename = download(date - timedelta(days = 3))
+			filename = download(date - timedelta(days = 3), product)
 			found = True
 		except:
 			print('File not found: ', date)
 			break
 		date = date + timedelta(days = 1)
-		csvFile.writerow(dayvol(filename, True))
+		csvFile.writerow(dayvol(filename, product))
+		if saveThicknessHistograms:
+			publish(getHistogramFileName(product, *product.getDates(filename)))
+		newFiles.append(filename)
 	outFile.close()
+	if custom_regions.regions:
+		for product, filenames in itertools.groupby(newFiles, products.getProductForFile):
+			appendCustomRegionRows(getCustomRegionRows(list(filenames), product))
 	date = date - timedelta(days = 1)
 	return date	
 
@@ -181,42 +421,90 @@ def getNsidcLandMask():
 	landmaskcenter = (n-1)/2
 	return landmask
 	
+def getNsidcProjection(grid):
+	"""
+	For every grid cell that falls on an ocean pixel of the NSIDC map, the flat index of the cell and of that pixel.
+	Computed once per grid and shared by all products and dates on that grid.
+    """
+	def compute():
+		landmask = getNsidcLandMask()
+		landmaskSize = landmask.shape[0]
+		latitude = grid.getLatitude()
+		longitude = grid.getLongitude()
+		rad = 360*sqrt(2)*np.sin(pi*(90-latitude)/360)
+		y = np.round(landmaskcenter+rad*np.sin(pi*longitude/180.0)).astype(int)
+		x = np.round(landmaskcenter+rad*np.cos(pi*longitude/180.0)).astype(int)
+		inside = (x >= 0) & (y >= 0) & (x < landmaskSize) & (y < landmaskSize)
+		inside[inside] = landmask[x[inside], y[inside]] != 0 # skip land
+		cells = np.nonzero(inside.ravel())[0]
+		return cells, (x*landmaskSize + y).ravel()[cells]
+	return grid.getCached('nsidcProjection', compute)
+
 def insertCryosatDataInNsidcMask(cryosatData, day, year, dummyvalue):
-	
+	"""
+	Project gridded CryoSat data onto the NSIDC map: each map pixel gets the mean of the grid cells falling on it.
+	Land pixels are 0, ocean pixels without any grid cell keep dummyvalue.
+    """
 	landmask = getNsidcLandMask()
 	landmask = landmask*dummyvalue
-	landmaskSize = landmask.shape[0]
-	counter=1000.0
 	rand = (year+day-2000)/200000.0 #random.randrange(1,100000)/10000000.0
 	
 	_,numberOfRows,numberOfColumns = cryosatData.shape
-	isnew = numberOfRows == 864
-	for i in range(0,numberOfRows):
-		for j in range(0,numberOfColumns):
-			v = cryosatData[0,i,j]
-			latitude = latlarge[i,j] if isnew else lat[i,j]
-			longitude = lonlarge[i,j] if isnew else lon[i,j]
-			rad = 360*sqrt(2)*sin(pi*(90-latitude)/360)
-			y = int(round(landmaskcenter+rad*sin(pi*longitude/180.0)))
-			x = int(round(landmaskcenter+rad*cos(pi*longitude/180.0)))
-			
-			if(x < 0 or y < 0 or x >= landmaskSize or y >= landmaskSize or landmask[x,y] == 0): #or mask[i,j] == -1
-				continue				
-			if not type(v) is np.float64:
-				v = 0
-			if(landmask[x,y] == dummyvalue):
-				landmask[x,y] = 0
-			landmask[x,y] += counter + max(v, rand)
-
-	for x in range(0,landmask.shape[0]):
-		for y in range(0,landmask.shape[1]):
-			if(landmask[x,y] == 0 or landmask[x,y] == dummyvalue):
-				continue
-			n = floor(landmask[x,y]/counter)
-			landmask[x,y] = (landmask[x,y] - counter*n)/n
-			
+	cells, pixels = getNsidcProjection(products.getGrid(numberOfRows))
+	values = np.nan_to_num(np.ma.filled(cryosatData[0], 0).ravel()[cells]) # missing values count as 0
+	sums = np.bincount(pixels, weights=np.maximum(values, rand), minlength=landmask.size)
+	counts = np.bincount(pixels, minlength=landmask.size)
+	flat = landmask.ravel()
+	hit = counts > 0
+	flat[hit] = sums[hit] / counts[hit]
 	return landmask
 
+projectedFolder = 'data/projected/'
+projectedFields = {}
+
+def getProjectedThickness(date):
+	"""
+	Thickness of a date projected onto the NSIDC map (before interpolation), cached in memory and in data/projected/.
+	The cache is keyed by the file name, size and modification time of the netCDF file, so a re-downloaded file is
+	projected again. The returned array is shared and read-only: copy it before modifying it.
+    """
+	product = products.getProduct(date)
+	localFileName = product.getLocalFileName(date)
+	with getFileLock(localFileName):
+		if not os.path.isfile(localFileName):
+			download(date, product)
+		source = os.stat(localFileName)
+	stem = projectedFolder + os.path.splitext(product.getFileName(date))[0]
+	cacheFileName = stem + '-{}-{}.npy'.format(source.st_size, source.st_mtime_ns)
+	with getFileLock(cacheFileName):
+		if cacheFileName not in projectedFields:
+			if os.path.isfile(cacheFileName):
+				landmask = np.load(cacheFileName)
+			else:
+				landmask = insertCryosatDataInNsidcMask(getGriddedThickness(date, product), date.timetuple().tm_yday, date.year, dummyvalue)
+				os.makedirs(projectedFolder, exist_ok=True)
+				partFileName = cacheFileName + '.' + str(os.getpid()) + '.part' # other processes may write the same file
+				with open(partFileName, 'wb') as f:
+					np.save(f, landmask)
+				os.replace(partFileName, cacheFileName) # never leave a partial file under the final name
+				for stale in glob.glob(glob.escape(stem) + '-*.npy'):
+					if stale != cacheFileName:
+						os.remove(stale)
+			landmask.flags.writeable = False
+			projectedFields[cacheFileName] = landmask
+		return projectedFields[cacheFileName]
+
+def getDifferenceField(current, previous):
+	"""
+	Thickness change between two projected fields. Land stays 0, pixels without data on either day are interpolated.
+    """
+	difference = current - previous
+	missing = (current == dummyvalue) | (previous == dummyvalue)
+	difference[missing] = dummyvalue
+	difference[current == 0] = 0
+	difference[(current != 0) & ~missing & (difference == 0)] = np.finfo(float).tiny # no change is not land
+	return difference
+
 def getInterpolatedValue(x, y, landmask, dummyvalue):
 	radius = 1
 	while(radius < 10):
@@ -258,7 +546,7 @@ def interpolate(landmask, dummyvalue, anomalyplot):
 					
 	return mask
 
-def plotThickness(landmask,plotTitle,filename,dropboxFilename):
+def getThicknessColormaps():
 	cdict = {'red':   ((0.0,  0.5, 0.5),
 					   (0.001, 0.5, 0.0),
 		           	   (0.05, 0.0, 0.0),
@@ -391,6 +679,10 @@ def plotThickness(landmask,plotTitle,filename,dropboxFilename):
 					   (0.9, 0.0, 0.0),
 					   (1.0,  0.0, 0.0))}
 	kleurbrol = LinearSegmentedColormap('BlueRed2', cbrol)
+	return kleur, kleurbrol
+
+def plotThickness(landmask,plotTitle,filename,dropboxFilename):
+	kleur, kleurbrol = getThicknessColormaps()
 	mask = landmask[30:-70,10:-70]#[50:-90,80:-90]#landmask[85:-100,95:-100]#landmask[30:-70,10:-70]
 	n = landmask.shape[0]
 	try:
@@ -415,7 +707,7 @@ def plotThickness(landmask,plotTitle,filename,dropboxFilename):
 	if dropboxFilename != '':
 		plt.savefig(dropboxFilename + '.png')
 	
-def plotAnomaly(landmask, plotTitle, filename, dropboxFilename):
+def getAnomalyColormaps():
 	cdict = {'red': ((0.0,  0.4, 0.4),
          	       (0.001, 0.0, 0.0),
          	       #(0.4, 0.8, 0.8),
@@ -449,6 +741,10 @@ def plotAnomaly(landmask, plotTitle, filename, dropboxFilename):
 					   (0.5, 1, 0.5),
 					   (1.0,  0.0, 0.0))}
 	kleurbrol = LinearSegmentedColormap('BlueRed4', cbrol)
+	return kleur, kleurbrol
+
+def plotAnomaly(landmask, plotTitle, filename, dropboxFilename):
+	kleur, kleurbrol = getAnomalyColormaps()
 	mask = landmask[30:-70,10:-70]#[50:-90,80:-90]#landmask[85:-100,95:-100]#landmask[30:-70,10:-70]
 	n = mask.shape[0]
 	m = mask.shape[1]
@@ -475,6 +771,29 @@ def plotAnomaly(landmask, plotTitle, filename, dropboxFilename):
 	if dropboxFilename != '':
 		plt.savefig(dropboxFilename + '.png')
 	
+def writeThicknessTiles(landmask, tileFolder):
+	"""
+	Write a map tile pyramid of the projected thickness field (or of the native EASE2 grid). 
+    """
+	kleur, _ = getThicknessColormaps()
+	rgba = map_tiles.colourMap(landmask, kleur, 0, thicknessmax)
+	return map_tiles.writeTilePyramid(rgba, tileFolder)
+
+def writeAnomalyTiles(landmask, tileFolder):
+	"""
+	Write a map tile pyramid of the projected thickness anomaly field. 
+    """
+	kleur, _ = getAnomalyColormaps()
+	rgba = map_tiles.colourMap(landmask, kleur, -anomalymax, anomalymax)
+	return map_tiles.writeTilePyramid(rgba, tileFolder)
+	
+def getTileManifests(tileFolders):
+	"""
+	Manifests of the tile pyramids, as task outputs: a deleted tile folder makes the task run again, and publishing
+	a manifest uploads the tiles of its pyramid.
+    """
+	return [os.path.join(tileFolder, map_tiles.manifestFileName) for tileFolder in tileFolders] if writeMapTiles else []
+
 def addMasks(landmask, mask, multiplier, dummyvalue):
 	for x in range(0,landmask.shape[0]):
 		for y in range(0,landmask.shape[1]):
@@ -484,88 +803,119 @@ def addMasks(landmask, mask, multiplier, dummyvalue):
 
 	return landmask
 	
-def dayvol(filename, isnewversion) :
+regionOrder = [RegionCode.okhotsk, RegionCode.bering, RegionCode.beaufort, RegionCode.chukchi, RegionCode.ess, RegionCode.laptev, RegionCode.kara, 
+	RegionCode.barents, RegionCode.greenland, RegionCode.cab, RegionCode.caa, RegionCode.baffin, RegionCode.hudson] # order of the CSV columns, followed by 'other'
+
+def getRegionIndex(grid):
+	"""
+	Position in regionOrder of the region of every grid cell (len(regionOrder) for other regions).
+	Computed once per grid and cached in data/region-index/, since the neighbor search takes a few seconds.
+    """
+	def compute():
+		cacheFileName = 'data/region-index/region-codes-' + grid.name + '-' + hashlib.md5(mask.tobytes()).hexdigest()[:16] + '.npy'
+		if os.path.isfile(cacheFileName):
+			return np.load(cacheFileName)
+		codes = mask.astype(int)
+		for row, col in zip(*np.nonzero(mask == -1)): # only cells without a region code need a neighbor search
+			try:
+				regionCode = getClosestRegionCode(row,col)
+			except IndexError: # no valid neighbor inside the mask
+				regionCode = None
+			codes[row,col] = -1 if regionCode is None else regionCode
+		factor = grid.rows // mask.shape[0]
+		maskRows = np.minimum(np.round(np.arange(grid.rows)/factor).astype(int), mask.shape[0]-1)
+		codes = codes[np.ix_(maskRows, maskRows)]
+		regionIndex = np.full(codes.shape, len(regionOrder))
+		for k, regionCode in enumerate(regionOrder):
+			regionIndex[codes == regionCode] = k
+		regionIndex[codes == RegionCode.stlawrence] = len(regionOrder)+1 # counted in the total only
+		os.makedirs(os.path.dirname(cacheFileName), exist_ok=True)
+		np.save(cacheFileName, regionIndex.ravel())
+		return regionIndex.ravel()
+	return grid.getCached('regionIndex', compute)
+
+thicknessBinEdges = [0.5, 1.0, 1.5, 2.0, 2.5, 3.0, 3.5, 4.0] # m, 0.5 m classes; the last class is everything above 4 m
+histogramFolder = 'data/thickness-histograms/'
+
+def getHistogramRegions():
+	return list(season_statistics.regionColumns)[:len(regionOrder)+1] + ['stlawrence']
+
+def getThicknessHistogram(thickness, cellArea, cellVolume, regionIndex):
+	"""
+	Ice area (km²) and volume (km³) per region (rows, see getHistogramRegions) and thickness class (columns),
+	from a single grouped sum over the combined region and class index of every cell with data.
+    """
+	classes = len(thicknessBinEdges) + 1
+	shape = (len(regionOrder)+2, classes)
+	valid = np.isfinite(cellVolume) & np.isfinite(thickness)
+	combined = regionIndex[valid] * classes + np.digitize(thickness[valid], thicknessBinEdges)
+	area = np.bincount(combined, weights=cellArea[valid], minlength=shape[0]*shape[1]).reshape(shape)
+	volume = np.bincount(combined, weights=cellVolume[valid], minlength=shape[0]*shape[1]).reshape(shape)
+	return area, volume
+
+def getHistogramFileName(product, startstr, endstr):
+	return histogramFolder + product.name + '-' + startstr + '-' + endstr + '.npz'
+
+def saveThicknessHistogram(product, startstr, endstr, area, volume):
+	os.makedirs(histogramFolder, exist_ok=True)
+	np.savez_compressed(getHistogramFileName(product, startstr, endstr),
+		area=area.astype(np.float32), volume=volume.astype(np.float32),
+		regions=np.array(getHistogramRegions()), binEdges=np.array(thicknessBinEdges))
+
+def dayvol(filename, product) :
 	"""
 	Calculate regional volume for a daily gridded thickness file. 
     """	
-	dates = filename.split('_')
-	startstr = dates[7 if isnewversion else 5]
-	endstr = dates[8 if isnewversion else 6]
+	startstr, endstr = product.getDates(filename)
 	print('inside dayvol',startstr, endstr)
 	
-	f = Dataset(filename, 'r', format="NETCDF4")
-	
-	# read sea ice concentration, thickness and thickness uncertainty
-	
-	prefix = 'analysis_' if not isnewversion else ''
-	sic = f.variables['sea_ice_concentration'][:].squeeze()
-	sit = f.variables[prefix + 'sea_ice_thickness'][:]
-	sit_unc = f.variables[prefix + 'sea_ice_thickness_unc' + ('ertainty' if isnewversion else '')][:].squeeze()	
-	
-	f.close()
+	gg = product.grid.cellArea   # Area of a grid cell
+	rows = product.grid.rows
+	shape = (rows, rows)
+	gridarea = product.grid.getCellAreaGrid()
 
-	gg = grid_spacing_km**2 * (0.25 if isnewversion else 1)   # Area of 25km EASE grid
-	rows = 864 if isnewversion else 432 
-	gridarea = np.full((rows,rows), gg)
+	with datasetLock:
+		f = Dataset(filename, 'r', format="NETCDF4")
+		
+		# read sea ice concentration, thickness and thickness uncertainty (NaN where there is no data)
+		
+		sic = readVariable(f, product.concentrationVariable, 'sic').reshape(shape)
+		sit = readVariable(f, product.thicknessVariable, 'sit').reshape(shape)
+		sit_unc = readVariable(f, product.uncertaintyVariable, 'sit_unc').reshape(shape)
+		
+		f.close()
 
-	# Volume
-	per_grid_cell_volume = (sic/100.) * sit * gg
+	# Volume, in float64 and in the order of the original masked-array expression, so that the per-cell volumes
+	# rounded below are the same whatever type the inputs were decoded to
+	per_grid_cell_volume = np.divide(sic, 100., out=getBuffer('volume', shape, np.float64), dtype=np.float64)
+	per_grid_cell_volume *= sit
+	per_grid_cell_volume *= gg
 	volume = np.nansum(per_grid_cell_volume) / 1000.0
-	per_grid_cell_uncertainty = per_grid_cell_volume * np.sqrt((sic_unc/sic)**2. + (sit_unc/sit)**2.)
+	with np.errstate(divide='ignore', invalid='ignore'): # no concentration or thickness: NaN, ignored by nansum
+		relative = np.square(np.divide(sic_unc, sic, out=getBuffer('relative', shape, np.float64), dtype=np.float64), out=getBuffer('relative', shape, np.float64))
+		relative += np.square(np.divide(sit_unc, sit, out=getBuffer('term', shape, np.float64), dtype=np.float64), out=getBuffer('term', shape, np.float64))
+		per_grid_cell_uncertainty = np.multiply(np.sqrt(relative, out=relative), per_grid_cell_volume, out=relative)
 	volume_uncertainty = np.nansum(per_grid_cell_uncertainty) / 1000.0
 
 	# Extent and Area
-	extent = gridarea[(sic>=thresh)&(sic<=100.)].sum()
-	area = gg * 0.01 * sic[(sic>=thresh)&(sic<=100.)].sum()
+	extent = gridarea[(sic>=thresh)&(sic<=100.)].sum(dtype=np.float64)
+	area = gg * 0.01 * sic[(sic>=thresh)&(sic<=100.)].sum(dtype=np.float64)
 
-	# Regional volume
-	vtotal, vhudson, vlawrence, vbaffin, vcaa, vbeaufort, vchukchi, vess, vlaptev, vkara, vbarents, vgreenland, vcab, vbering, vokhotsk, vother = (0,)*16
-	_,numberOfRows,numberOfColumns = per_grid_cell_volume.shape
-	
-	for row in range(numberOfRows): 		# numberOfRows = 432
-		for col in range(numberOfColumns): 	# numberOfColumns = 432
-		
-			entry = per_grid_cell_volume[0,row,col]
-			if type(entry) is np.float64:
-				entry /= 1000.0
-				entry = round(entry,3)
-				vtotal += entry
-
-				factor = 2 if numberOfRows == 864 else 1
-				regionCode = getClosestRegionCode(round(row/factor),round(col/factor))
-
-				if regionCode == RegionCode.cab:
-					vcab += entry
-				elif regionCode == RegionCode.beaufort:
-					vbeaufort += entry
-				elif regionCode == RegionCode.chukchi:
-					vchukchi += entry
-				elif regionCode == RegionCode.ess:
-					vess += entry
-				elif regionCode == RegionCode.laptev:
-					vlaptev += entry
-				elif regionCode == RegionCode.kara:
-					vkara += entry
-				elif regionCode == RegionCode.barents:
-					vbarents += entry
-				elif regionCode == RegionCode.greenland:
-					vgreenland += entry
-				elif regionCode == RegionCode.baffin:
-					vbaffin += entry
-				elif regionCode == RegionCode.stlawrence:
-					vlawrence += entry
-				elif regionCode == RegionCode.hudson:
-					vhudson += entry
-				elif regionCode == RegionCode.caa:
-					vcaa += entry
-				elif regionCode == RegionCode.bering:
-					vbering += entry
-				elif regionCode == RegionCode.okhotsk:
-					vokhotsk += entry
-				else:
-					vother += entry
+	# Regional volume: one grouped sum over the region index of every cell with data
+	entries = np.divide(per_grid_cell_volume, 1000.0, out=getBuffer('entries', shape, np.float64)).ravel()
+	np.round(entries, 3, out=entries)
+	valid = ~np.isnan(entries)
+	regionIndex = getRegionIndex(product.grid)
+	regional = np.bincount(regionIndex[valid], weights=entries[valid], minlength=len(regionOrder)+2)[:len(regionOrder)+1]
+	vtotal = np.cumsum(entries[valid])[-1] if valid.any() else 0.0 # added one by one in row order, as the original loop did
+
+	if saveThicknessHistograms:
+		cellArea = np.multiply(sic, gg/100., out=getBuffer('cellArea', shape, np.float64), dtype=np.float64)
+		cellVolume = np.divide(per_grid_cell_volume, 1000.0, out=getBuffer('cellVolume', shape, np.float64))
+		area, volumes = getThicknessHistogram(sit.ravel(), cellArea.ravel(), cellVolume.ravel(), regionIndex)
+		saveThicknessHistogram(product, startstr, endstr, area, volumes)
 	
-	return startstr, endstr, rounded(vokhotsk), rounded(vbering), rounded(vbeaufort), rounded(vchukchi), rounded(vess), rounded(vlaptev), rounded(vkara), rounded(vbarents), rounded(vgreenland), rounded(vcab), rounded(vcaa), rounded(vbaffin), rounded(vhudson), rounded(vother), rounded(vtotal), rounded(volume_uncertainty)#, rounded(area), rounded(extent)	
+	return (startstr, endstr) + tuple(rounded(v) for v in regional) + (rounded(vtotal), rounded(volume_uncertainty))#, rounded(area), rounded(extent)
 
 def createAverage(date):
 	startyear = 2014 if date.month <= 4 else 2013
@@ -590,39 +940,80 @@ def createAverage(date):
 	np.savetxt(savedFileName, landmask, delimiter = ',', fmt='%d') #, fmt="%.3f", fmt='%d'
 
 def plotDate(date):
-	griddedThickness = getGriddedThickness(date)
-
-	dayOfYear = date.timetuple().tm_yday
-	multiplier = 1
-	landmask = insertCryosatDataInNsidcMask(griddedThickness, dayOfYear, date.year, dummyvalue)
-	landmask = interpolate(landmask, dummyvalue, False)
+	landmask = interpolate(getProjectedThickness(date), dummyvalue, False)
 
 	plotTitle = "CryoSat-SMOS sea ice thickness " + str(date.day) + " " + monthNames[date.month-1] + " " + str(date.year)
 	filename = 'cryosat-smos-thickness-' + str(date.year) + padzeros(date.month) + padzeros(date.day)
 	dropboxFilename = ''			
-	plotThickness(landmask,plotTitle,filename,dropboxFilename)
+	with pyplotLock:
+		plotThickness(landmask,plotTitle,filename,dropboxFilename)
 			
-def uploadToGoogleDrive():
-	upload_to_google_drive.replace_file_in_google_drive('1jSihYCk2KkQuMvw1TAldinJy5WGLdygQ','cryosat-smos-volume-cab.png')
-	upload_to_google_drive.replace_file_in_google_drive('1477yE9AJBPcH8Pz7QZA21Fjj9g8ipKVg', "cryosat-smos-volume-caa.png")
-	upload_to_google_drive.replace_file_in_google_drive('1DON43_2oHN4T8yvpm4xV49ONZmFZ7mvw',"cryosat-smos-volume-beaufort.png")
-	upload_to_google_drive.replace_file_in_google_drive('1MrWT5RScXMmojfJFmOKo8P0TXQelGolp',"cryosat-smos-volume-chukchi.png")
-	upload_to_google_drive.replace_file_in_google_drive('1_B4Ylz7H4FA5ezO70fOf8HjJn1Fl1FW8',"cryosat-smos-volume-bering.png")
-	upload_to_google_drive.replace_file_in_google_drive('13gWz-I_ya0mDsi-OGTInKKuitkBmTvXk',"cryosat-smos-volume-ess.png")
-	upload_to_google_drive.replace_file_in_google_drive('1_djGUUYmXCp9nmHwoxQTfLFlSNzHFDLV',"cryosat-smos-volume-laptev.png")
-	upload_to_google_drive.replace_file_in_google_drive('1bU5B2oD_IhsCiFqycAMNPgz6h9n-1j8O',"cryosat-smos-volume-kara.png")
-	upload_to_google_drive.replace_file_in_google_drive('1WNW-kRoDeoa3Nohejq56ECqZmwqVmxda',"cryosat-smos-volume-barents.png")
-	upload_to_google_drive.replace_file_in_google_drive('1GeO_esf9Dw98tD1gK4uxNHTnuEOe4KXW',"cryosat-smos-volume-greenland.png")
-	upload_to_google_drive.replace_file_in_google_drive('1b0igRzMVHUqynwEIFmYt6kFWdFLkc2Ji',"cryosat-smos-volume-baffin.png")
-	upload_to_google_drive.replace_file_in_google_drive('1fzHE-S8sC_p3IqFkOKQBGZFXGKsObvqW',"cryosat-smos-volume-hudson.png")
-	upload_to_google_drive.replace_file_in_google_drive('15jjBCAVOFWzOzDQeTLoyHntXyD328ZVL',"cryosat-smos-volume-okhotsk.png")
+googleDriveFiles = [
+	('1jSihYCk2KkQuMvw1TAldinJy5WGLdygQ', 'cryosat-smos-volume-cab.png'),
+	('1477yE9AJBPcH8Pz7QZA21Fjj9g8ipKVg', 'cryosat-smos-volume-caa.png'),
+	('1DON43_2oHN4T8yvpm4xV49ONZmFZ7mvw', 'cryosat-smos-volume-beaufort.png'),
+	('1MrWT5RScXMmojfJFmOKo8P0TXQelGolp', 'cryosat-smos-volume-chukchi.png'),
+	('1_B4Ylz7H4FA5ezO70fOf8HjJn1Fl1FW8', 'cryosat-smos-volume-bering.png'),
+	('13gWz-I_ya0mDsi-OGTInKKuitkBmTvXk', 'cryosat-smos-volume-ess.png'),
+	('1_djGUUYmXCp9nmHwoxQTfLFlSNzHFDLV', 'cryosat-smos-volume-laptev.png'),
+	('1bU5B2oD_IhsCiFqycAMNPgz6h9n-1j8O', 'cryosat-smos-volume-kara.png'),
+	('1WNW-kRoDeoa3Nohejq56ECqZmwqVmxda', 'cryosat-smos-volume-barents.png'),
+	('1GeO_esf9Dw98tD1gK4uxNHTnuEOe4KXW', 'cryosat-smos-volume-greenland.png'),
+	('1b0igRzMVHUqynwEIFmYt6kFWdFLkc2Ji', 'cryosat-smos-volume-baffin.png'),
+	('1fzHE-S8sC_p3IqFkOKQBGZFXGKsObvqW', 'cryosat-smos-volume-hudson.png'),
+	('15jjBCAVOFWzOzDQeTLoyHntXyD328ZVL', 'cryosat-smos-volume-okhotsk.png'),
+]
+
+dropboxFiles = [
+	'cryosat-smos-regional-volume.csv',
+	'cryosat-smos-regional-volume-derived.csv',
+	customRegionFileName,
+	season_statistics.bandsFileName,
+	season_statistics.statisticsFileName,
+	'cryosat-smos-volume-total.png',
+	'cryosat-smos-thickness-latest.png',
+	'cryosat-smos-thickness-anomaly-latest.png',
+	'animation_cryosat_smos_latest.gif',
+]
+
+def uploadToDropbox(filename):
+	dropbox_client.uploadToDropbox([filename])
+
+def uploadTilesToDropbox(manifestPath):
+	"""
+	Upload the tiles of a pyramid that changed since it was last published, then its manifest.
+    """
+	tileFolder = os.path.dirname(manifestPath)
+	dropbox_client.uploadToDropbox(map_tiles.getChangedTiles(tileFolder))
+	map_tiles.markPublished(tileFolder)
+
+def getPublishTargets(filename):
+	"""
+	(target, destination, upload function) for every place an artifact is published to.
+    """
+	targets = []
+	if putOnDropbox and filename in dropboxFiles:
+		targets.append(('dropbox', filename, uploadToDropbox))
+	if putOnDropbox and filename.startswith(histogramFolder):
+		targets.append(('dropbox', filename, uploadToDropbox))
+	if putOnDropbox and filename.startswith('tiles/') and os.path.basename(filename) == map_tiles.manifestFileName:
+		targets.append(('dropbox', filename, uploadTilesToDropbox)) # queued once per manifest content, see UploadQueue
+	for fileId, driveFilename in googleDriveFiles:
+		if driveFilename == filename:
+			targets.append(('google-drive', fileId, lambda filename, fileId = fileId: upload_to_google_drive.replace_file_in_google_drive(fileId, filename)))
+	return targets
+
+def publish(filename):
+	for target, destination, upload in getPublishTargets(filename):
+		uploadQueue.submit(target, filename, upload, destination)
+
+def publishOutputs(task):
+	for filename in task.outputs:
+		publish(filename)
 
 mask = np.loadtxt(open("regional-mask.csv", "rb"), delimiter=",", skiprows=0)
 refmask = np.loadtxt(open("analysis_sea_ice_thickness_20220415.csv", "rb"), delimiter=",", skiprows=0)
-lat = np.loadtxt(open("lat.csv", "rb"), delimiter=",", skiprows=0)
-lon = np.loadtxt(open("lon.csv", "rb"), delimiter=",", skiprows=0)
-latlarge = np.loadtxt(open("latlarge.csv", "rb"), delimiter=",", skiprows=0)
-lonlarge = np.loadtxt(open("lonlarge.csv", "rb"), delimiter=",", skiprows=0)
+# lat/lon grids are loaded on first use, see products.Grid
 
 """
 Alternative way to load the regional mask:
@@ -633,6 +1024,13 @@ mask = file.variables['region_code'][:].squeeze()
 file.close()
 """
 
+pyplotLock = threading.Lock() # pyplot keeps global state, so only one task can draw at a time
+datasetLock = threading.Lock()
+fileLocksLock = threading.Lock()
+fileLocks = {}
+decodeBuffers = threading.local() # see getBuffer
+uploadQueue = upload_queue.UploadQueue()
+
 dummyvalue=10
 thicknessmax = 4.0
 anomalymax = 1.0
@@ -653,66 +1051,184 @@ thicknessmax = 4.0
 anomalymax = 1.0
 anomyears = 10 # 10 years in anomaly base
 
-if auto:
-	plotCryosatThickness = True
-	plotCryosatAnomaly = True
+def getLocalFileName(date):
+	return products.getProduct(date).getLocalFileName(date)
 
-	latestDate = downloadNewFiles()
+def getThicknessFileName(date):
+	return 'cryosat-smos-thickness-' + str(date.year) + padzeros(date.month) + padzeros(date.day) + '.png'
 
-	date = latestDate
-	date = date - timedelta(days = 3)
-	griddedThickness = getGriddedThickness(date)
-		
-	dayOfYear = date.timetuple().tm_yday
-	print('day',date.day)
+def getAnomalyFileName(date):
+	return 'cryosat-smos-thickness-anomaly-' + str(date.year) + padzeros(date.month) + padzeros(date.day) + '.png'
+
+def getAnomalyBaseDates(date):
+	"""
+	The same day in each of the previous anomyears years; 29 February is compared with 28 February in years without it.
+    """
+	baseDates = []
+	for year in range(date.year - 1, date.year - anomyears - 1, -1):
+		day = 28 if date.month == 2 and date.day == 29 and not isleap(year) else date.day
+		baseDates.append(datetime(year, date.month, day))
+	return baseDates
 
-if plotCryosatThickness:
-	multiplier = 1
-	landmask = insertCryosatDataInNsidcMask(griddedThickness, dayOfYear, date.year, dummyvalue)
-	landmask = interpolate(landmask, dummyvalue, False)
+def plotLatestThickness(date):
+	landmask = interpolate(getProjectedThickness(date), dummyvalue, False)
 
 	plotTitle = "CryoSat-SMOS sea ice thickness " + str(date.day) + " " + monthNames[date.month-1] + " " + str(date.year)
 	filename = 'cryosat-smos-thickness-' + str(date.year) + padzeros(date.month) + padzeros(date.day)
-	dropboxFilename = 'cryosat-smos-thickness-latest'			
-	plotThickness(landmask,plotTitle,filename,dropboxFilename)
+	dropboxFilename = 'cryosat-smos-thickness-latest'
+	with pyplotLock:
+		plotThickness(landmask,plotTitle,filename,dropboxFilename)
+	if writeMapTiles:
+		writeThicknessTiles(landmask, 'tiles/thickness-latest')
+		writeThicknessTiles(getGriddedThickness(date)[0], 'tiles/thickness-ease2-latest')
 
-if plotCryosatAnomaly:
+def plotAnomalyDate(date, dropboxFilename = ''):
 	multiplier = -1.0/anomyears 
-	landmask = insertCryosatDataInNsidcMask(griddedThickness, dayOfYear, date.year, dummyvalue)
+	landmask = getProjectedThickness(date).copy()
 	print('plotting cryosat anomaly', date)
-	folderMonth = date.month
-	for k in range(anomyears):
-		compyear = date.year - k - 1 # year-k-1
-		griddedThickness = getGriddedThickness(datetime(compyear,date.month,date.day))
-		maskbis = insertCryosatDataInNsidcMask(griddedThickness, dayOfYear, compyear, dummyvalue)
-		landmask = addMasks(landmask, maskbis, multiplier, dummyvalue)
+	for compdate in getAnomalyBaseDates(date):
+		landmask = addMasks(landmask, getProjectedThickness(compdate), multiplier, dummyvalue)
 
 	landmask = interpolate(landmask, dummyvalue, True)
 
-	print(date.day)
 	plotTitle = "CryoSat-SMOS thickness anomaly " + str(date.day) + " " + monthNames[date.month-1] + " " + str(date.year) + " vs " + str(date.year-10) + "-" + str(date.year-1)
 	filename = 'cryosat-smos-thickness-anomaly-' + str(date.year) + padzeros(date.month) + padzeros(date.day)
-	dropboxFilename = 'cryosat-smos-thickness-anomaly-latest'
-	plotAnomaly(landmask,plotTitle,filename,dropboxFilename)
+	with pyplotLock:
+		plotAnomaly(landmask,plotTitle,filename,dropboxFilename)
+	return landmask
+
+def plotLatestAnomaly(date):
+	landmask = plotAnomalyDate(date, 'cryosat-smos-thickness-anomaly-latest')
+	if writeMapTiles:
+		writeAnomalyTiles(landmask, 'tiles/thickness-anomaly-latest')
+
+def getChangeMapFileName(date, days):
+	return 'cryosat-smos-thickness-change-' + str(days) + 'd-' + str(date.year) + padzeros(date.month) + padzeros(date.day) + '.png'
+
+def plotChangeMap(date, days):
+	"""
+	Thickness change map of a date versus a number of days earlier, from the cached projected fields.
+    """
+	previousDate = date - timedelta(days = days)
+	landmask = interpolate(getDifferenceField(getProjectedThickness(date), getProjectedThickness(previousDate)), dummyvalue, True)
+	plotTitle = "CryoSat-SMOS thickness change " + str(date.day) + " " + monthNames[date.month-1] + " " + str(date.year) + " vs " + str(previousDate.day) + " " + monthNames[previousDate.month-1]
+	with pyplotLock:
+		plotAnomaly(landmask, plotTitle, os.path.splitext(getChangeMapFileName(date, days))[0], '')
+
+def getFrameFileName(field, date):
+	return getThicknessFileName(date) if field == 'thickness' else getAnomalyFileName(date)
+
+def getFrameInputDates(field, date):
+	return [date] if field == 'thickness' else [date] + getAnomalyBaseDates(date)
+
+def renderFrame(field, date):
+	"""
+	Render one animation frame, unless it already exists. Runs in a worker process.
+    """
+	filename = getFrameFileName(field, date)
+	if not os.path.isfile(filename):
+		if field == 'thickness':
+			plotDate(date)
+		else:
+			plotAnomalyDate(date)
+		projectedFields.clear() # the fields stay cached on disk; keep the memory of the worker constant
+	return filename
+
+def makeSeasonAnimations(startDate, endDate, fields = None, workers = None):
+	"""
+	Animate a whole season. Input files are downloaded first; dates whose files are not available are skipped
+	as missing dates. Missing frames are rendered in a process pool and streamed into the GIF in date order.
+    """
+	for field in fields or seasonAnimationFields:
+		dates = make_animation.getFrameDates(startDate, endDate)
+		with ThreadPoolExecutor(max_workers=4) as executor:
+			available = list(executor.map(lambda date: all(downloadIfMissing(inputDate, products.getProduct(inputDate)) for inputDate in getFrameInputDates(field, date)), dates))
+		missingDates = [date for date, isAvailable in zip(dates, available) if not isAvailable]
+		frameDates = make_animation.getFrameDates(startDate, endDate, missingDates)
+		animationFileName = 'animation_cryosat_smos_' + field + '_' + startDate.strftime('%Y%m%d') + '_' + endDate.strftime('%Y%m%d') + '.gif'
+		with process_pool.getProcessPool(workers) as executor:
+			make_animation.writeAnimation(executor.map(renderFrame, [field]*len(frameDates), frameDates), animationFileName)
+		print('written', animationFileName, len(frameDates), 'frames,', len(missingDates), 'missing dates')
+
+def plotRegionalGraphs():
+	with pyplotLock:
+		regional_python_graphs.plotRegionalGraphs()
+
+def buildTaskGraph(date):
+	"""
+	Declare every artifact of the daily run with its input files, so that unchanged artifacts are skipped.
+	Outputs are queued for upload as soon as the task producing them is done.
+    """
+	graph = task_graph.TaskGraph(onDone = publishOutputs)
+	key = str(date.date())
+	csvFileName = 'cryosat-smos-regional-volume.csv'
+	
+	if plotCryosatThickness:
+		graph.addTask('thickness-map', lambda: plotLatestThickness(date),
+			inputs = [getLocalFileName(date)],
+			outputs = [getThicknessFileName(date), 'cryosat-smos-thickness-latest.png'] + getTileManifests(['tiles/thickness-latest', 'tiles/thickness-ease2-latest']), key = key)
+
+	if plotCryosatAnomaly:
+		graph.addTask('anomaly-map', lambda: plotLatestAnomaly(date),
+			inputs = [getLocalFileName(d) for d in [date] + getAnomalyBaseDates(date)],
+			outputs = [getAnomalyFileName(date), 'cryosat-smos-thickness-anomaly-latest.png'] + getTileManifests(['tiles/thickness-anomaly-latest']), key = key)
 
-if auto:
 	animationFileName = 'animation_cryosat_smos_latest.gif' 
 	frames = 10
+	frameFileNames = []
 	for k in range(frames):
 		previousdate = date - timedelta(days = k)
-		filename = 'cryosat-smos-thickness-' + str(previousdate.year) + padzeros(previousdate.month) + padzeros(previousdate.day) + '.png'
-		if not os.path.isfile(filename):
-			plotDate(previousdate)
-		
-	make_animation.makeAnimation(date, frames, animationFileName, lambda date: 'cryosat-smos-thickness-' + str(date.year) + padzeros(date.month) + padzeros(date.day) + '.png')
-	if putOnDropbox:
-		dropbox_client.uploadToDropbox([animationFileName])
+		frameFileNames.append(getThicknessFileName(previousdate))
+		if k == 0 and plotCryosatThickness:
+			continue # produced by the thickness-map task
+		graph.addTask('frame-' + str(previousdate.date()), lambda previousdate = previousdate: plotDate(previousdate),
+			inputs = [getLocalFileName(previousdate)],
+			outputs = [getThicknessFileName(previousdate)], key = str(previousdate.date()))
+	for k in range(changeMapDays):
+		changeDate = date - timedelta(days = k)
+		graph.addTask('change-map-1d-' + str(changeDate.date()), lambda changeDate = changeDate: plotChangeMap(changeDate, 1),
+			inputs = [getLocalFileName(changeDate), getLocalFileName(changeDate - timedelta(days = 1))],
+			outputs = [getChangeMapFileName(changeDate, 1)], key = str(changeDate.date()))
+	if changeMapDays:
+		graph.addTask('change-map-' + str(changeMapDays) + 'd', lambda: plotChangeMap(date, changeMapDays),
+			inputs = [getLocalFileName(date), getLocalFileName(date - timedelta(days = changeMapDays))],
+			outputs = [getChangeMapFileName(date, changeMapDays)], key = key)
+	graph.addTask('animation', lambda: make_animation.makeAnimation(date, frames, animationFileName, getThicknessFileName),
+		inputs = frameFileNames, outputs = [animationFileName], key = key)
 
-	outFile = open('cryosat-smos-regional-volume.csv', 'a', newline='')
-	csvFile = csv.writer(outFile)
+	graph.addTask('derived-series', lambda: derived_series.updateDerivedSeries(csvFileName),
+		inputs = [csvFileName], outputs = [derived_series.derivedFileName, derived_series.stateFileName])
+	graph.addTask('regional-graphs', plotRegionalGraphs,
+		inputs = [csvFileName, derived_series.derivedFileName],
+		outputs = [filename for _, _, _, _, filename in regional_python_graphs.regionalPlots] + ['cryosat-smos-regional-volume-7x2.png'])
+	graph.addTask('season-statistics', lambda: season_statistics.updateStatistics(csvFileName),
+		inputs = [csvFileName], outputs = [season_statistics.bandsFileName, season_statistics.statisticsFileName])
+	return graph
+
+if productComparison:
+	processProducts(*productComparison)
+
+if seasonAnimation:
+	makeSeasonAnimations(*seasonAnimation)
 
-	time.sleep(3)
-	regional_python_graphs.plotRegionalGraphs()
+if customRegionBackfill:
+	backfillCustomRegions(*customRegionBackfill)
+
+if auto:
+	plotCryosatThickness = True
+	plotCryosatAnomaly = True
+
+	latestDate = downloadNewFiles()
+	publish('cryosat-smos-regional-volume.csv')
+	if custom_regions.regions:
+		publish(customRegionFileName)
+
+	date = latestDate
+	date = date - timedelta(days = 3)
+	print('day',date.day)
 
-	time.sleep(3)
-	uploadToGoogleDrive()
+	results = buildTaskGraph(date).run()
+	print('task results', results)
+	uploads = uploadQueue.flush()
+	if any(result in ('failed', 'blocked') for result in results.values()) or any(upload.startswith('failed') for upload in uploads.values()):
+		sys.exit(1)
@@ -0,0 +1,177 @@
+import hashlib
+import os
+from math import pi
+import numpy as np
+from matplotlib.path import Path
+
+earthRadius = 6371.228  # km, radius of the EASE2 sphere
+indexFolder = 'data/region-index/'
+
+regions = []          # registered (name, kind, definition) tuples, in column order
+compiledIndexes = {}  # in-memory cache of compiled indexes, keyed by definition and grid hash
+
+def registerPolygon(name, vertices):
+	"""
+	Register a region bounded by a polygon of (latitude, longitude) vertices.
+	Edges are interpolated linearly in latitude and longitude, so a box follows parallels and meridians.
+    """
+	registerRegion(name, 'polygon', [(float(latitude), float(longitude)) for latitude, longitude in vertices])
+
+def registerLatitudeBand(name, minLatitude, maxLatitude):
+	"""
+	Register a region covering all cells between two latitudes.
+    """
+	registerRegion(name, 'band', (float(minLatitude), float(maxLatitude)))
+
+def registerMask(name, mask):
+	"""
+	Register a region as a boolean (or fractional) mask over the 432x432 or 864x864 lat/lon grid.
+    """
+	registerRegion(name, 'mask', np.asarray(mask, dtype=float))
+
+def registerRegion(name, kind, definition):
+	if any(existing == name for existing, _, _ in regions):
+		raise ValueError('region already registered: ' + name)
+	regions.append((name, kind, definition))
+
+def getRegionNames():
+	return [name for name, _, _ in regions]
+
+def project(latitude, longitude):
+	"""
+	Project latitude/longitude onto the (spherical) EASE2 north polar Lambert azimuthal equal-area plane, in km.
+    """
+	rho = 2 * earthRadius * np.sin(pi/4 - np.radians(latitude)/2)
+	return rho * np.sin(np.radians(longitude)), -rho * np.cos(np.radians(longitude))
+
+def latitudeOf(x, y):
+	return 90 - 2 * np.degrees(np.arcsin(np.clip(np.hypot(x, y) / (2 * earthRadius), -1, 1)))
+
+def densify(vertices, steps = 32):
+	"""
+	Interpolate points along the polygon edges, so that edges stay on the intended latitude/longitude path once projected.
+    """
+	points = []
+	for k in range(len(vertices)):
+		lat1, lon1 = vertices[k]
+		lat2, lon2 = vertices[(k+1) % len(vertices)]
+		dlon = (lon2 - lon1 + 180) % 360 - 180 # shortest way around
+		for t in np.arange(steps) / steps:
+			points.append((lat1 + t*(lat2 - lat1), lon1 + t*dlon))
+	return np.array(points)
+
+def getSubsampleOffsets(gridSpacingKm, subsamples):
+	offsets = ((np.arange(subsamples) + 0.5) / subsamples - 0.5) * gridSpacingKm
+	dx, dy = np.meshgrid(offsets, offsets)
+	return dx.ravel(), dy.ravel()
+
+def getCoverage(candidates, x, y, gridSpacingKm, subsamples, inside):
+	"""
+	Fraction of each candidate cell covered by the region, by testing subsamples x subsamples points per cell.
+    """
+	dx, dy = getSubsampleOffsets(gridSpacingKm, subsamples)
+	px = (x[candidates][:,None] + dx[None,:]).ravel()
+	py = (y[candidates][:,None] + dy[None,:]).ravel()
+	return inside(px, py).reshape(len(candidates), len(dx)).mean(axis=1)
+
+def getPolygonWeights(vertices, x, y, gridSpacingKm, subsamples):
+	polygonX, polygonY = project(*densify(vertices).T)
+	path = Path(np.column_stack((polygonX, polygonY)))
+	margin = gridSpacingKm
+	candidates = np.nonzero((x >= polygonX.min() - margin) & (x <= polygonX.max() + margin) & (y >= polygonY.min() - margin) & (y <= polygonY.max() + margin))[0]
+	inside = lambda px, py: path.contains_points(np.column_stack((px, py)))
+	return candidates, getCoverage(candidates, x, y, gridSpacingKm, subsamples, inside)
+
+def getBandWeights(band, latitude, x, y, gridSpacingKm, subsamples):
+	minLatitude, maxLatitude = band
+	margin = gridSpacingKm / 100.0 # degrees of latitude, comfortably more than half a cell
+	full = np.nonzero((latitude >= minLatitude + margin) & (latitude <= maxLatitude - margin))[0]
+	edge = np.nonzero((latitude > minLatitude - margin) & (latitude < maxLatitude + margin) & ~((latitude >= minLatitude + margin) & (latitude <= maxLatitude - margin)))[0]
+	inside = lambda px, py: (latitudeOf(px, py) >= minLatitude) & (latitudeOf(px, py) <= maxLatitude)
+	cells = np.concatenate((full, edge))
+	return cells, np.concatenate((np.ones(len(full)), getCoverage(edge, x, y, gridSpacingKm, subsamples, inside)))
+
+def getMaskWeights(mask, shape):
+	if mask.shape != shape:
+		factor = shape[0] // mask.shape[0]
+		if factor * mask.shape[0] != shape[0] or factor * mask.shape[1] != shape[1]:
+			raise ValueError('mask of shape ' + str(mask.shape) + ' does not fit grid of shape ' + str(shape))
+		mask = np.repeat(np.repeat(mask, factor, axis=0), factor, axis=1)
+	weights = np.nan_to_num(mask.ravel())
+	cells = np.nonzero(weights)[0]
+	return cells, weights[cells]
+
+class RegionIndex:
+	"""
+	Compiled cell-weight index of all registered regions on one grid.
+	Cells of all regions are concatenated, sorted by region, so that all regions are evaluated in one reduction.
+    """
+	def __init__(self, names, gridSize, cells, weights, offsets):
+		self.names = names
+		self.gridSize = gridSize
+		self.cells = cells
+		self.weights = weights
+		self.offsets = offsets
+
+	def evaluate(self, perCellValues):
+		"""
+		Sum the per-cell values of one grid over every region, weighted by the cell coverage. Missing values count as zero.
+	    """
+		return self.evaluateStack(np.reshape(np.ma.filled(perCellValues, np.nan), (1, self.gridSize)))[0]
+
+	def evaluateStack(self, perCellValues):
+		"""
+		Same as evaluate, for a stack of grids (days): returns a days x regions array from a single reduction.
+	    """
+		values = np.asarray(np.ma.filled(perCellValues, np.nan), dtype=float).reshape((-1, self.gridSize))
+		weighted = np.zeros((values.shape[0], len(self.cells) + 1)) # padded, so that every offset is a valid index
+		np.multiply(np.nan_to_num(values[:, self.cells]), self.weights, out=weighted[:, :-1])
+		sums = np.add.reduceat(weighted, self.offsets[:-1], axis=1)
+		sums[:, self.offsets[:-1] == self.offsets[1:]] = 0 # reduceat does not give zero for empty regions
+		return sums
+
+def getDefinitionHash(lat, lon, gridSpacingKm, subsamples):
+	digest = hashlib.md5(repr((gridSpacingKm, subsamples, lat.shape)).encode('utf-8'))
+	digest.update(np.ascontiguousarray(lat).tobytes())
+	digest.update(np.ascontiguousarray(lon).tobytes())
+	for name, kind, definition in regions:
+		digest.update(repr((name, kind)).encode('utf-8'))
+		digest.update(definition.tobytes() if kind == 'mask' else repr(definition).encode('utf-8'))
+	return digest.hexdigest()
+
+def compileRegions(lat, lon, gridSpacingKm, subsamples = 5):
+	"""
+	Compile all registered regions into a RegionIndex for the grid with the given cell latitudes/longitudes.
+	The index is cached in memory and in data/region-index/, and only recompiled when the regions or the grid change.
+    """
+	key = getDefinitionHash(lat, lon, gridSpacingKm, subsamples)
+	if key in compiledIndexes:
+		return compiledIndexes[key]
+	names = getRegionNames()
+	indexFileName = indexFolder + 'regions-' + str(lat.shape[0]) + '-' + key[:16] + '.npz'
+	if os.path.isfile(indexFileName):
+		saved = np.load(indexFileName)
+		index = RegionIndex(names, lat.size, saved['cells'], saved['weights'], saved['offsets'])
+	else:
+		print('compiling region index', indexFileName)
+		latitude = lat.ravel()
+		valid = np.isfinite(latitude) & np.isfinite(lon.ravel())
+		x, y = project(np.where(valid, latitude, 0), np.where(valid, lon.ravel(), 0))
+		allCells, allWeights, offsets = [], [], [0]
+		for name, kind, definition in regions:
+			if kind == 'polygon':
+				cells, weights = getPolygonWeights(definition, x, y, gridSpacingKm, subsamples)
+			elif kind == 'band':
+				cells, weights = getBandWeights(definition, latitude, x, y, gridSpacingKm, subsamples)
+			else:
+				cells, weights = getMaskWeights(definition, lat.shape)
+			keep = (weights > 0) & valid[cells]
+			allCells.append(cells[keep])
+			allWeights.append(weights[keep])
+			offsets.append(offsets[-1] + np.count_nonzero(keep))
+		index = RegionIndex(names, lat.size, np.concatenate(allCells + [np.zeros(0, dtype=np.int64)]).astype(np.int64),
+			np.concatenate(allWeights + [np.zeros(0)]), np.array(offsets))
+		os.makedirs(indexFolder, exist_ok=True)
+		np.savez(indexFileName, cells=index.cells, weights=index.weights, offsets=index.offsets)
+	compiledIndexes[key] = index
+	return index
@@ -0,0 +1,144 @@
+import json
+import os
+import zlib
+from collections import deque
+import numpy as np
+from season_statistics import regionColumns, seasonLength, getDayOfSeason
+
+windows = (7, 30)           # rolling trend windows, in days
+derivedFileName = 'cryosat-smos-regional-volume-derived.csv'
+stateFileName = 'data/derived-series.json'
+
+def getHeader():
+	header = ['start', 'end']
+	for region in regionColumns:
+		header += [region + '_change'] + [region + '_trend' + str(window) for window in windows]
+	return header
+
+def getSeasonBounds(row):
+	"""
+	First and last CSV row of the season a row belongs to.
+    """
+	_, day = getDayOfSeason(row)
+	return max(row - day, 0), row - day + seasonLength - 1
+
+class RollingTrend:
+	"""
+	Least-squares slope over the last `window` days, for all regions at once. The slope is computed from the days
+	in the window only (t counted from the start of the window), so it does not depend on where a recomputation starts.
+    """
+	def __init__(self, window, regions):
+		self.window = window
+		self.regions = regions
+		self.values = deque(maxlen=window)
+		self.t = np.arange(window) - (window - 1) / 2.0 # centred, so the slope is sum(t*y) / sum(t²)
+
+	def push(self, y):
+		self.values.append(y)
+
+	def slope(self):
+		if len(self.values) < self.window:
+			return np.full(self.regions, np.nan)
+		return self.t.dot(np.array(self.values)) / self.t.dot(self.t)
+
+def deriveRows(volumes, firstRow, fromRow):
+	"""
+	Derived values (km³ and km³/day) of the rows fromRow..firstRow+len(volumes)-1, given the volumes of consecutive
+	CSV rows starting at firstRow. The rows before fromRow only warm up the windows; no window crosses a season gap.
+    """
+	derived = []
+	trends = None
+	season = None
+	for row, volume in enumerate(volumes, firstRow):
+		if getDayOfSeason(row)[0] != season:
+			season = getDayOfSeason(row)[0]
+			trends = [RollingTrend(window, len(volume)) for window in windows]
+			previous = None
+		for trend in trends:
+			trend.push(volume)
+		if row >= fromRow:
+			change = volume - previous if previous is not None else np.full(len(volume), np.nan)
+			derived.append(np.column_stack([change] + [trend.slope() for trend in trends]).ravel())
+		previous = volume
+	return derived
+
+def formatRow(dates, values):
+	return ','.join(list(dates) + ['' if np.isnan(v) else '{:.2f}'.format(v) for v in values]) + '\n'
+
+def readRows(csvFileName):
+	"""
+	Dates, volumes per region and checksum of every data row of the regional volume CSV.
+    """
+	dates, volumes, checksums = [], [], []
+	with open(csvFileName, 'r') as f:
+		next(f) # header
+		for line in f:
+			if not line.strip():
+				continue
+			fields = line.split(',')
+			dates.append((fields[0].strip(), fields[1].strip()))
+			volumes.append([float(fields[col]) for col in regionColumns.values()])
+			checksums.append(zlib.crc32(line.encode('utf-8')))
+	return dates, np.array(volumes).reshape((-1, len(regionColumns))), checksums
+
+def getDirtyRows(checksums, previousChecksums):
+	"""
+	Rows whose derived values have to be (re)computed: new rows, and the windows following every changed row.
+    """
+	dirty = set()
+	maxWindow = max(windows)
+	for row, checksum in enumerate(checksums):
+		if row < len(previousChecksums) and previousChecksums[row] == checksum:
+			continue
+		_, seasonEnd = getSeasonBounds(row)
+		dirty.update(range(row, min(row + maxWindow, seasonEnd + 1, len(checksums))))
+	return sorted(dirty)
+
+def getRuns(rows):
+	"""
+	Group sorted row numbers into (first, last) runs of consecutive rows.
+    """
+	runs = []
+	for row in rows:
+		if runs and runs[-1][1] == row - 1:
+			runs[-1][1] = row
+		else:
+			runs.append([row, row])
+	return runs
+
+def updateDerivedSeries(csvFileName, filename = derivedFileName, stateFileName = stateFileName):
+	"""
+	Bring the daily change and rolling trends in line with the regional volume CSV. Only new rows, and the rows whose
+	window contains a changed row, are recomputed. Returns the number of recomputed rows.
+    """
+	previousChecksums = []
+	lines = []
+	if os.path.isfile(stateFileName) and os.path.isfile(filename):
+		with open(stateFileName, 'r') as f:
+			state = json.load(f)
+		with open(filename, 'r') as f:
+			lines = f.readlines()[1:]
+		if state['header'] == getHeader() and len(lines) == len(state['checksums']):
+			previousChecksums = state['checksums']
+	dates, volumes, checksums = readRows(csvFileName)
+	dirtyRows = getDirtyRows(checksums, previousChecksums)
+	lines = lines[:len(previousChecksums)] + [''] * max(len(checksums) - len(previousChecksums), 0)
+	lines = lines[:len(checksums)]
+	maxWindow = max(windows)
+	for first, last in getRuns(dirtyRows):
+		seasonStart, _ = getSeasonBounds(first)
+		warmup = max(seasonStart, first - maxWindow)
+		for row, values in enumerate(deriveRows(volumes[warmup:last+1], warmup, first), first):
+			lines[row] = formatRow(dates[row], values)
+
+	if dirtyRows or len(checksums) != len(previousChecksums):
+		with open(filename + '.tmp', 'w') as f:
+			f.write(','.join(getHeader()) + '\n')
+			f.writelines(lines)
+		os.replace(filename + '.tmp', filename)
+	os.makedirs(os.path.dirname(stateFileName), exist_ok=True)
+	with open(stateFileName + '.tmp', 'w') as f:
+		json.dump({'header': getHeader(), 'checksums': checksums}, f)
+	os.replace(stateFileName + '.tmp', stateFileName)
+	print('derived series: recomputed rows', len(dirtyRows))
+	return len(dirtyRows)
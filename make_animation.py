@@ -1,10 +1,10 @@
-import contextlib
+import os
 from datetime import datetime, timedelta
-from PIL import Image
+from PIL import Image, GifImagePlugin
 
 def makeAnimation(enddate, frames, animationFileName, getFileNameFromDate, missingDates = [], endpause = 5):
 	date = datetime(enddate.year, enddate.month, enddate.day)
-	
+
 	filenames = []
 	counter = 0
 	while counter < frames:
@@ -18,14 +18,45 @@ def makeAnimation(enddate, frames, animationFileName, getFileNameFromDate, missi
 		counter += 1
 		date = date - timedelta(days = 1)
 	filenames.reverse()
-	
-	lastfilename = filenames[-1]
-	for k in range(endpause):
-		filenames.append(lastfilename)
-	with contextlib.ExitStack() as stack:
-		imgs = (stack.enter_context(Image.open(f)) for f in filenames)
-		img = next(imgs)
-		# https://pillow.readthedocs.io/en/stable/handbook/image-file-formats.html#gif
-		startdate = enddate - timedelta(days = frames-1)
-		img.save(fp=animationFileName, format='GIF', append_images=imgs, save_all=True, duration=500, loop=0) #, quality=25, optimize=True, compress_level=9)
-		compress_string = "magick mogrify -layers Optimize -fuzz 7% " + animationFileName
+
+	writeAnimation(filenames, animationFileName, endpause = endpause)
+	#compress_string = "magick mogrify -layers Optimize -fuzz 7% " + animationFileName
+
+def getFrameDates(startdate, enddate, missingDates = []):
+	"""
+	All dates from startdate to enddate, except the missing dates.
+    """
+	dates = []
+	date = datetime(startdate.year, startdate.month, startdate.day)
+	while date <= enddate:
+		if date in missingDates:
+			print('missing date: ', date)
+		else:
+			dates.append(date)
+		date = date + timedelta(days = 1)
+	return dates
+
+def writeAnimation(filenames, animationFileName, duration = 500, endpause = 5):
+	"""
+	Encode frame images into a looping GIF one at a time, so that memory use does not grow with the number of frames.
+	filenames may be an iterator that yields frames while they are being produced. The last frame is shown endpause frames longer.
+    """
+	previous = None
+	with open(animationFileName + '.part', 'wb') as fp:
+		for filename in filenames:
+			if previous is not None:
+				writeFrame(fp, previous, duration)
+			with Image.open(filename) as im:
+				previous = im.convert('RGB').convert('P', palette=Image.Palette.ADAPTIVE)
+			if fp.tell() == 0:
+				# https://pillow.readthedocs.io/en/stable/handbook/image-file-formats.html#gif
+				header, _ = GifImagePlugin.getheader(previous, info={'loop': 0, 'duration': duration})
+				fp.write(b''.join(header))
+		if previous is None:
+			raise ValueError('no frames for animation ' + animationFileName)
+		writeFrame(fp, previous, duration * (endpause + 1))
+		fp.write(b';') # trailer
+	os.replace(animationFileName + '.part', animationFileName)
+
+def writeFrame(fp, frame, duration):
+	fp.write(b''.join(GifImagePlugin.getdata(frame, duration=duration, include_color_table=True)))
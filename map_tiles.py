@@ -0,0 +1,101 @@
+import hashlib
+import json
+import os
+import shutil
+from math import ceil, log2
+import numpy as np
+from PIL import Image
+
+manifestFileName = 'tiles.json'
+uploadedManifestFileName = 'tiles-uploaded.json' # manifest of the tiles as last published
+
+def colourMap(field, cmap, vmin, vmax):
+	"""
+	Colour-map a 2D field once into an RGBA byte array, using the same normalisation as imshow.
+    """
+	values = np.ma.filled(np.ma.asarray(field, dtype=float), np.nan)
+	normalized = np.clip((values - vmin) / (vmax - vmin), 0, 1)
+	rgba = cmap(normalized, bytes=True)
+	rgba[np.isnan(values)] = 0 # transparent where there is no data
+	return rgba
+
+def padToPyramid(rgba, tileSize):
+	"""
+	Pad an RGBA array with transparent pixels to a square of tileSize * 2^maxZoom pixels.
+    """
+	size = max(rgba.shape[0], rgba.shape[1])
+	maxZoom = max(0, int(ceil(log2(size / tileSize))))
+	n = tileSize * 2**maxZoom
+	padded = np.zeros((n, n, 4), dtype=np.uint8)
+	padded[:rgba.shape[0], :rgba.shape[1]] = rgba
+	return padded, maxZoom
+
+def downsample(rgba):
+	"""
+	Halve the resolution of an RGBA array by averaging 2x2 pixel blocks.
+	Colours are averaged with premultiplied alpha, so transparent pixels do not darken the edges of the data.
+    """
+	n = rgba.shape[0] // 2
+	blocks = rgba.reshape(n, 2, n, 2, 4).astype(np.uint32)
+	alpha = blocks[..., 3].sum(axis=(1,3))
+	premultiplied = (blocks[..., :3] * blocks[..., 3:]).sum(axis=(1,3))
+	result = np.zeros((n, n, 4), dtype=np.uint8)
+	opaque = alpha > 0
+	result[..., :3][opaque] = ((premultiplied[opaque] + alpha[opaque][:, None] // 2) // alpha[opaque][:, None]).astype(np.uint8)
+	result[..., 3] = (alpha + 2) // 4
+	return result
+
+def writeTilePyramid(rgba, tileFolder, tileSize = 256):
+	"""
+	Cut a colour-mapped RGBA array into a tile pyramid tileFolder/{zoom}/{x}/{y}.png.
+	Lower zoom levels are obtained by downsampling the same array instead of re-rendering.
+	Tiles whose content did not change since the previous run are not rewritten.
+	Returns the list of tiles that were written.
+    """
+	manifestPath = os.path.join(tileFolder, manifestFileName)
+	previous = {}
+	if os.path.isfile(manifestPath):
+		with open(manifestPath, 'r') as f:
+			previous = json.load(f)
+
+	level, maxZoom = padToPyramid(rgba, tileSize)
+	manifest = {}
+	written = []
+	for zoom in range(maxZoom, -1, -1):
+		tiles = level.shape[0] // tileSize
+		for x in range(tiles):
+			for y in range(tiles):
+				tile = level[y*tileSize:(y+1)*tileSize, x*tileSize:(x+1)*tileSize]
+				path = os.path.join(str(zoom), str(x), str(y) + '.png')
+				digest = hashlib.md5(tile.tobytes()).hexdigest()
+				manifest[path] = digest
+				fullPath = os.path.join(tileFolder, path)
+				if previous.get(path) == digest and os.path.isfile(fullPath):
+					continue
+				os.makedirs(os.path.dirname(fullPath), exist_ok=True)
+				Image.fromarray(tile, 'RGBA').save(fullPath)
+				written.append(fullPath)
+		if zoom > 0:
+			level = downsample(level)
+
+	with open(manifestPath, 'w') as f:
+		json.dump(manifest, f, indent=1, sort_keys=True)
+	print('tiles written', tileFolder, len(written), 'of', len(manifest))
+	return written
+
+def getChangedTiles(tileFolder):
+	"""
+	Tiles of a pyramid that changed since it was last published (see markPublished), and the manifest itself.
+    """
+	with open(os.path.join(tileFolder, manifestFileName), 'r') as f:
+		manifest = json.load(f)
+	published = {}
+	publishedPath = os.path.join(tileFolder, uploadedManifestFileName)
+	if os.path.isfile(publishedPath):
+		with open(publishedPath, 'r') as f:
+			published = json.load(f)
+	changed = [os.path.join(tileFolder, path) for path, digest in sorted(manifest.items()) if published.get(path) != digest]
+	return changed + [os.path.join(tileFolder, manifestFileName)]
+
+def markPublished(tileFolder):
+	shutil.copyfile(os.path.join(tileFolder, manifestFileName), os.path.join(tileFolder, uploadedManifestFileName))
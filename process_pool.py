@@ -0,0 +1,13 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+def getProcessPool(workers = None):
+	"""
+	Process pool whose workers are forked, so they inherit the loaded grids and caches and can run
+	functions defined in the main script. Falls back to threads where fork is not available.
+    """
+	try:
+		return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'))
+	except ValueError:
+		print('fork not available, using threads')
+		return ThreadPoolExecutor(max_workers=workers)
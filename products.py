@@ -0,0 +1,121 @@
+import os
+import threading
+from datetime import datetime, timedelta
+import numpy as np
+
+class Grid:
+	"""
+	EASE2 grid of a product. Products on the same grid share one Grid instance, and with it the static
+	coordinates and everything derived from them (region codes, projection onto the NSIDC map, region indexes).
+    """
+	def __init__(self, name, rows, gridSpacingKm, latFileName, lonFileName):
+		self.name = name
+		self.rows = rows
+		self.gridSpacingKm = gridSpacingKm
+		self.cellArea = gridSpacingKm**2
+		self.latFileName = latFileName
+		self.lonFileName = lonFileName
+		self.cache = {}
+		self.lock = threading.RLock() # computations may use other cached arrays of the grid
+
+	def getCached(self, name, compute):
+		"""
+		Compute a static array for this grid once, and share it between all products and tasks using the grid.
+	    """
+		with self.lock:
+			if name not in self.cache:
+				self.cache[name] = compute()
+			return self.cache[name]
+
+	def getLatitude(self):
+		return self.getCached('lat', lambda: np.loadtxt(open(self.latFileName, "rb"), delimiter=",", skiprows=0))
+
+	def getLongitude(self):
+		return self.getCached('lon', lambda: np.loadtxt(open(self.lonFileName, "rb"), delimiter=",", skiprows=0))
+
+	def getCellAreaGrid(self):
+		"""
+		Area of every grid cell (km²), a read-only array shared by all days.
+	    """
+		def compute():
+			area = np.full((self.rows, self.rows), self.cellArea, dtype=np.float32)
+			area.flags.writeable = False
+			return area
+		return self.getCached('cellAreaGrid', compute)
+
+class Product:
+	"""
+	Everything that differs between versions of the CryoSat-SMOS product: file names, variable names, grid and ftp folder layout.
+    """
+	def __init__(self, name, ftpFolder, filenamePrefix, grid, variablePrefix, uncertaintyVariable, dateFieldIndex,
+			latestFolderFrom = None, substituteDates = {}):
+		self.name = name
+		self.ftpFolder = ftpFolder
+		self.filenamePrefix = filenamePrefix
+		self.grid = grid
+		self.thicknessVariable = variablePrefix + 'sea_ice_thickness'
+		self.uncertaintyVariable = variablePrefix + uncertaintyVariable
+		self.concentrationVariable = 'sea_ice_concentration'
+		self.dateFieldIndex = dateFieldIndex       # position of the start date when the file name is split on '_'
+		self.latestFolderFrom = latestFolderFrom   # from this date on, files are operational ('o') and in the LATEST folder
+		self.substituteDates = substituteDates     # dates for which the file of another date has to be downloaded
+
+	def usesLatestFolder(self, date):
+		return self.latestFolderFrom is not None and date > self.latestFolderFrom
+
+	def getFileName(self, date):
+		startDate = date - timedelta(days = 3)
+		endDate = date + timedelta(days = 3)
+		datestring = startDate.strftime('%Y%m%d') + '_' + endDate.strftime('%Y%m%d') + '_' + ('o' if self.usesLatestFolder(date) else 'r')
+		return self.filenamePrefix + datestring + '_' + self.name + '_01_l4sit.nc'
+
+	def getLocalFileName(self, date):
+		return 'data/LATEST/' + self.getFileName(date)
+
+	def getFtpPath(self, date):
+		downloadFilename = self.getFileName(self.substituteDates.get(datetime(date.year, date.month, date.day), date)).replace(',','%2C')
+		ftpSubfolder = 'LATEST/' if self.usesLatestFolder(date) else date.strftime('%Y/%m/')
+		return self.ftpFolder + ftpSubfolder + downloadFilename
+
+	def getDates(self, filename):
+		"""
+		Start and end date strings of the averaging window of a file.
+	    """
+		fields = os.path.basename(filename).split('_')
+		return fields[self.dateFieldIndex], fields[self.dateFieldIndex + 1]
+
+	def getOutputSuffix(self):
+		return '-' + self.name
+
+grid25km = Grid('25km', 432, 25., 'lat.csv', 'lon.csv')
+grid12p5km = Grid('12p5km', 864, 12.5, 'latlarge.csv', 'lonlarge.csv')
+grids = [grid25km, grid12p5km]
+
+v206 = Product('v206', 'ftp://ftp.awi.de/sea_ice/product/cryosat2_smos/v206/nh/', 'W_XX-ESA,SMOS_CS2,NH_25KM_EASE2_',
+	grid25km, 'analysis_', 'sea_ice_thickness_unc', 5)
+v300 = Product('v300', 'ftp://ftp.awi.de/sea_ice/product/cryosat2_smos/v300/nh/', 'W_XX-ESA,SMOS_CS2_S3A_S3B,NH_12P5KM_EASE2_',
+	grid12p5km, '', 'sea_ice_thickness_uncertainty', 7, latestFolderFrom = datetime(2025,9,1),
+	substituteDates = {datetime(2025,3,25): datetime(2025,3,24)})
+	#ftp://ftp.awi.de/sea_ice/product/cryosat2_smos/v300/nh/W_XX-ESA,SMOS_CS2_S3A_S3B,NH_12P5KM_EASE2_20251015_20251021_o_v300_01_l4sit
+allProducts = {product.name: product for product in [v206, v300]}
+
+def getProduct(date):
+	"""
+	Product used by default for a date.
+    """
+	return v300 if date > datetime(2025,1,1) else v206
+
+def getProductByName(name):
+	return allProducts[name]
+
+def getProductForFile(filename):
+	for product in allProducts.values():
+		if '_' + product.name + '_' in filename:
+			return product
+	raise ValueError('unknown product for file ' + filename)
+
+def getGrid(rows):
+	for grid in grids:
+		if grid.rows == rows:
+			return grid
+	raise ValueError('no grid with ' + str(rows) + ' rows')
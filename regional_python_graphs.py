@@ -3,38 +3,98 @@ import matplotlib.pyplot as plt
 import numpy as np
 import matplotlib.ticker as ticker
 import sys
-import dropbox_client
+import os
+import re
+import json
+import hashlib
+import derived_series
+from season_statistics import regionColumns
 
-putOnDropbox = True
+regionalPlots = [ # column, ymin, ymax, title, file name
+	(4, 0, 1.4, "Beaufort Sea CryoSat-SMOS ice volume", "cryosat-smos-volume-beaufort.png"),
+	(5, 0, 1.4, "Chukchi Sea CryoSat-SMOS ice volume", "cryosat-smos-volume-chukchi.png"),
+	(6, 0, 1.4, "East Siberian Sea CryoSat-SMOS ice volume", "cryosat-smos-volume-ess.png"),
+	(7, 0, 0.7, "Laptev Sea CryoSat-SMOS ice volume", "cryosat-smos-volume-laptev.png"),
+	(8, 0, 1.0, "Kara Sea CryoSat-SMOS ice volume", "cryosat-smos-volume-kara.png"),
+	(9, 0, 0.5, "Barents Sea CryoSat-SMOS ice volume", "cryosat-smos-volume-barents.png"),
+	(10, 0, 1.0, "Greenland Sea CryoSat-SMOS ice volume", "cryosat-smos-volume-greenland.png"),
+	(11, 3, 11, "Central Arctic Basin CryoSat-SMOS ice volume", "cryosat-smos-volume-cab.png"),
+	(12, 0, 1.6, "Canadian Arctic Archipelago CryoSat-SMOS ice volume", "cryosat-smos-volume-caa.png"),
+	(13, 0, 1.0, "Baffin Bay CryoSat-SMOS ice volume", "cryosat-smos-volume-baffin.png"),
+	(14, 0, 1.3, "Hudson Bay CryoSat-SMOS ice volume", "cryosat-smos-volume-hudson.png"),
+	(15, 0, 0.12, "Other CryoSat-SMOS ice volume", "cryosat-smos-volume-other.png"),
+	(16, 0, 21, "Total CryoSat-SMOS ice volume", "cryosat-smos-volume-total.png"),
+	(3, 0, 0.5, "Bering Sea CryoSat-SMOS ice volume", "cryosat-smos-volume-bering.png"),
+	(2, 0, 0.35, "Sea of Okhotsk CryoSat-SMOS ice volume", "cryosat-smos-volume-okhotsk.png"),
+	(16, 0, 22, "CryoSat-SMOS Arctic sea ice volume", "cryosat-smos-volume.png"),
+]
 
-def printRegionalVolume(data, ax, col, ymin, ymax, name):
+seasons = [ # label, colour; the last season is the current one
+	('2010/11', (0.65,0.65,0.65)),
+	('2011/12', (0.44,0.19,0.63)),
+	('2012/13', (0.0,0.13,0.38)),
+	('2013/14', (0,0.44,0.75)),
+	('2014/15', (0.0,0.69,0.94)),
+	('2015/16', (0,0.69,0.31)),
+	('2016/17', (0.57,0.82,0.31)),
+	('2017/18', (1.0,0.75,0)),
+	('2018/19', (0.9,0.4,0.05)),
+	('2019/20', (1.0,0.5,0.5)),
+	('2020/21', (0.58,0.54,0.33)),
+	('2021/22', (0.4,0,0.2)),
+	('2022/23', (0.6,0.6,0.2)),
+	('2023/24', (0.7,0.2,0.3)),
+	('2024/25', (0.3,0.2,0.3)),
+	('2025/26', (1.0,0,0)),
+]
+
+regionalPanelFiles = [ # charts shown as panels in the 7x2 overview
+	"cryosat-smos-volume-beaufort.png",
+	"cryosat-smos-volume-chukchi.png",
+	"cryosat-smos-volume-ess.png",
+	"cryosat-smos-volume-laptev.png",
+	"cryosat-smos-volume-kara.png",
+	"cryosat-smos-volume-barents.png",
+	"cryosat-smos-volume-greenland.png",
+	"cryosat-smos-volume-cab.png",
+	"cryosat-smos-volume-caa.png",
+	"cryosat-smos-volume-baffin.png",
+	"cryosat-smos-volume-hudson.png",
+	"cryosat-smos-volume-bering.png",
+	"cryosat-smos-volume-okhotsk.png",
+	"cryosat-smos-volume-total.png",
+]
+regionalPanels = [(col, ymin, ymax, title) for filename in regionalPanelFiles # column, ymin, ymax, title
+	for col, ymin, ymax, title, plotFileName in regionalPlots if plotFileName == filename]
+
+useCachedBackground = True
+backgroundFolder = 'data/chart-backgrounds/'
+trendWindows = [7, 30] # rolling trends (days, see derived_series.windows) drawn as dashed lines through the latest day
+trendDays = 14    # days the trend lines are extended beyond the latest day
+trendStyles = ['--', ':', '-.']
+
+def getSeasonMatrix(data, col):
+	"""
+	Reshape a CSV column into a (season x day of season) matrix in 10^3 km³. 
+    """
 	regional = data[1:,col]
 	regional = np.array([i.lstrip() for i in regional]).astype(float)
 	padded = np.pad(regional, (177-171, 171+177*15 - regional.shape[0]), 'constant', constant_values=(np.nan,))
 	matrix = padded.reshape((16,177))
 	matrix = matrix/1000.0
+	return matrix
+
+def printHistoricalSeasons(matrix, ax, ymin, ymax, name):
+	"""
+	Draw everything that does not depend on the current season: past seasons, axes, grid and title. 
+    """
 	dates = np.arange(1,178)
-	
-	ax.plot(dates, matrix[-16,:], label='2010/11', color=(0.65,0.65,0.65));
-	ax.plot(dates, matrix[-15,:], label='2011/12', color=(0.44,0.19,0.63));
-	ax.plot(dates, matrix[-14,:], label='2012/13', color=(0.0,0.13,0.38));
-	ax.plot(dates, matrix[-13,:], label='2013/14', color=(0,0.44,0.75));
-	ax.plot(dates, matrix[-12,:], label='2014/15', color=(0.0,0.69,0.94));
-	ax.plot(dates, matrix[-11,:], label='2015/16', color=(0,0.69,0.31));
-	ax.plot(dates, matrix[-10,:], label='2016/17', color=(0.57,0.82,0.31));
-	ax.plot(dates, matrix[-9,:], label='2017/18', color=(1.0,0.75,0));
-	ax.plot(dates, matrix[-8,:], label='2018/19', color=(0.9,0.4,0.05));
-	ax.plot(dates, matrix[-7,:], label='2019/20', color=(1.0,0.5,0.5));
-	ax.plot(dates, matrix[-6,:], label='2020/21', color=(0.58,0.54,0.33));
-	ax.plot(dates, matrix[-5,:], label='2021/22', color=(0.4,0,0.2));
-	ax.plot(dates, matrix[-4,:], label='2022/23', color=(0.6,0.6,0.2));
-	ax.plot(dates, matrix[-3,:], label='2023/24', color=(0.7,0.2,0.3));
-	ax.plot(dates, matrix[-2,:], label='2024/25', color=(0.3,0.2,0.3));
-	ax.plot(dates, matrix[-1,:], label='2025/26', color=(1.0,0,0), linewidth=3);
+	for k in range(len(seasons)-1):
+		label, color = seasons[k]
+		ax.plot(dates, matrix[k,:], label=label, color=color);
 	#ax.set_xlabel("day")
 	ax.set_ylabel("Sea ice volume (10$^3\!$ km$^3\!$)")
 	ax.set_title(name)
-	ax.legend(loc=4, prop={'size': 8})#, bbox_to_anchor=(0.75,1))
 	#ax.text(75, .025, 'some text')
 	#ax.text(2.5, 2.5, r'$\mu=115,\ \sigma=15$')
 	ax.axis([0, 177, ymin, ymax])
@@ -54,63 +114,135 @@ def printRegionalVolume(data, ax, col, ymin, ymax, name):
 	#for tick in ax.xaxis.get_minor_ticks():
 	#	tick.label1.set_horizontalalignment('center')
 
-	
-def saveRegionalPlot(col, ymin, ymax, data, name, filename):
-	#print('inside saveRegionalPlot', name)
-	fig, axs = plt.subplots(figsize=(8, 5))
-	printRegionalVolume(data, axs, col, ymin, ymax, name)
+def getLatestTrends(derived, col):
+	"""
+	(window, km³/day) of the latest rolling trends of the region in a CSV column, from the derived series.
+    """
+	if derived is None:
+		return []
+	region = [region for region, regionCol in regionColumns.items() if regionCol == col][0]
+	header = list(derived[0])
+	trends = []
+	for window in trendWindows:
+		value = derived[-1, header.index(region + '_trend' + str(window))].strip()
+		if value:
+			trends.append((window, float(value)))
+	return trends
+
+def printTrends(matrix, ax, trends):
+	days = np.nonzero(np.isfinite(matrix[-1,:]))[0]
+	if len(days) == 0:
+		return [] # the current season has not started yet
+	latest = days[-1] + 1
+	_, color = seasons[-1]
+	handles = []
+	for (window, slope), style in zip(trends, trendStyles):
+		x = np.array([latest - window + 1, latest + trendDays])
+		ax.plot(x, matrix[-1, latest-1] + slope/1000.0*(x - latest), linestyle=style, color=color, linewidth=1.5)
+		handles.append(mpl.lines.Line2D([], [], color=color, linestyle=style, label=str(window) + '-day trend'))
+	return handles
+
+def printCurrentSeason(matrix, ax, trends = []):
+	"""
+	Draw the current season, its trend lines and the legend on top of the historical seasons. 
+    """
+	dates = np.arange(1,178)
+	label, color = seasons[-1]
+	ax.plot(dates, matrix[-1,:], label=label, color=color, linewidth=3);
+	handles = [mpl.lines.Line2D([], [], color=color, label=label) for label, color in seasons[:-1]]
+	handles.append(mpl.lines.Line2D([], [], color=color, label=label, linewidth=3))
+	handles += printTrends(matrix, ax, trends)
+	ax.legend(handles=handles, loc=4, prop={'size': 8})#, bbox_to_anchor=(0.75,1))
+
+def printRegionalVolume(data, ax, col, ymin, ymax, name):
+	matrix = getSeasonMatrix(data, col)
+	printHistoricalSeasons(matrix, ax, ymin, ymax, name)
+	printCurrentSeason(matrix, ax)
+
+def createFigure(panels, figsize):
+	fig, axs = plt.subplots((len(panels)+1)//2 if len(panels) > 1 else 1, 2 if len(panels) > 1 else 1, figsize=figsize)
+	if len(panels) > 1:
+		fig.tight_layout(pad=5.0)
+	return fig, np.array(axs).flatten()
+
+def getBackgroundFileName(panels, matrices, figsize, filename):
+	"""
+	The background is keyed by a hash of the historical seasons and of the chart layout,
+	so it is only redrawn when past data (or the chart itself) changes.
+    """
+	digest = hashlib.md5(repr((panels, figsize, seasons, mpl.__version__)).encode('utf-8'))
+	for matrix in matrices:
+		digest.update(np.ascontiguousarray(matrix[:-1]).tobytes())
+	return backgroundFolder + os.path.splitext(filename)[0] + '-' + digest.hexdigest()[:16] + '.png'
+
+def saveBackground(fig, axs, backgroundFileName):
+	"""
+	Save a figure on which only the historical seasons are drawn as the cached background, with its panel positions.
+    """
+	print('saving chart background', backgroundFileName)
+	os.makedirs(backgroundFolder, exist_ok=True)
+	stem = os.path.basename(backgroundFileName)[:-len('-0123456789abcdef.png')]
+	stalePattern = re.compile(re.escape(stem) + r'-[0-9a-f]{16}\.(png|json)')
+	for stale in os.listdir(backgroundFolder):
+		if stalePattern.fullmatch(stale):
+			os.remove(os.path.join(backgroundFolder, stale))
+	fig.savefig(backgroundFileName)
+	with open(os.path.splitext(backgroundFileName)[0] + '.json', 'w') as f:
+		json.dump([list(ax.get_position().bounds) for ax in axs], f)
+
+def saveRegionalFigure(panels, data, figsize, filename, derived = None):
+	"""
+	Save a figure with one panel per (column, ymin, ymax, title) entry.
+	With useCachedBackground, only the current season is drawn on top of a cached background image. Without a
+	cached background the chart is drawn in full, and the background is saved from the same figure on the way.
+    """
+	matrices = [getSeasonMatrix(data, col) for col, _, _, _ in panels]
+	backgroundFileName = getBackgroundFileName(panels, matrices, figsize, filename)
+	if not useCachedBackground or not os.path.isfile(backgroundFileName):
+		fig, axs = createFigure(panels, figsize)
+		for (col, ymin, ymax, name), matrix, ax in zip(panels, matrices, axs):
+			printHistoricalSeasons(matrix, ax, ymin, ymax, name)
+		if useCachedBackground:
+			saveBackground(fig, axs, backgroundFileName)
+		for (col, ymin, ymax, name), matrix, ax in zip(panels, matrices, axs):
+			printCurrentSeason(matrix, ax, getLatestTrends(derived, col))
+		fig.savefig(filename)
+		plt.close(fig)
+		return
+
+	with open(os.path.splitext(backgroundFileName)[0] + '.json', 'r') as f:
+		positions = json.load(f)
+
+	fig = plt.figure(figsize=figsize)
+	fig.figimage(plt.imread(backgroundFileName), zorder=-1) # below the overlay axes
+	for (col, ymin, ymax, name), matrix, position in zip(panels, matrices, positions):
+		ax = fig.add_axes(position)
+		ax.set_axis_off() # axes, ticks and grid come from the background
+		ax.axis([0, 177, ymin, ymax])
+		printCurrentSeason(matrix, ax, getLatestTrends(derived, col))
 	fig.savefig(filename)
+	plt.close(fig)
+
+def saveRegionalPlot(col, ymin, ymax, data, name, filename, derived = None):
+	#print('inside saveRegionalPlot', name)
+	saveRegionalFigure([(col, ymin, ymax, name)], data, (8, 5), filename, derived)
 
 def plotRegionalGraphs():
 	csvFileName = "cryosat-smos-regional-volume.csv"
 	data = np.loadtxt(csvFileName, delimiter=",", dtype=str)
+	derived = None
+	if trendWindows and os.path.isfile(derived_series.derivedFileName):
+		derived = np.loadtxt(derived_series.derivedFileName, delimiter=",", dtype=str)
+
+	for col, ymin, ymax, name, filename in regionalPlots:
+		saveRegionalPlot(col, ymin, ymax, data, name, filename, derived)
 
-	saveRegionalPlot(4, 0, 1.4, data, "Beaufort Sea CryoSat-SMOS ice volume", "cryosat-smos-volume-beaufort.png")
-	saveRegionalPlot(5, 0, 1.4, data, "Chukchi Sea CryoSat-SMOS ice volume", "cryosat-smos-volume-chukchi.png")
-	saveRegionalPlot(6, 0, 1.4, data, "East Siberian Sea CryoSat-SMOS ice volume", "cryosat-smos-volume-ess.png")
-	saveRegionalPlot(7, 0, 0.7, data, "Laptev Sea CryoSat-SMOS ice volume", "cryosat-smos-volume-laptev.png")
-	saveRegionalPlot(8, 0, 1.0, data, "Kara Sea CryoSat-SMOS ice volume", "cryosat-smos-volume-kara.png")
-	saveRegionalPlot(9, 0, 0.5, data, "Barents Sea CryoSat-SMOS ice volume", "cryosat-smos-volume-barents.png")
-	saveRegionalPlot(10, 0, 1.0, data, "Greenland Sea CryoSat-SMOS ice volume", "cryosat-smos-volume-greenland.png")
-	saveRegionalPlot(11, 3, 11, data, "Central Arctic Basin CryoSat-SMOS ice volume", "cryosat-smos-volume-cab.png")
-	saveRegionalPlot(12, 0, 1.6, data, "Canadian Arctic Archipelago CryoSat-SMOS ice volume", "cryosat-smos-volume-caa.png")
-	saveRegionalPlot(13, 0, 1.0, data, "Baffin Bay CryoSat-SMOS ice volume", "cryosat-smos-volume-baffin.png")
-	saveRegionalPlot(14, 0, 1.3, data, "Hudson Bay CryoSat-SMOS ice volume", "cryosat-smos-volume-hudson.png")
-	saveRegionalPlot(15, 0, 0.12, data, "Other CryoSat-SMOS ice volume", "cryosat-smos-volume-other.png")
-	saveRegionalPlot(16, 0, 21, data, "Total CryoSat-SMOS ice volume", "cryosat-smos-volume-total.png")
-	saveRegionalPlot(3, 0, 0.5, data, "Bering Sea CryoSat-SMOS ice volume", "cryosat-smos-volume-bering.png")
-	saveRegionalPlot(2, 0, 0.35, data, "Sea of Okhotsk CryoSat-SMOS ice volume", "cryosat-smos-volume-okhotsk.png")
-	
-	saveRegionalPlot(16, 0, 22, data, "CryoSat-SMOS Arctic sea ice volume", "cryosat-smos-volume.png")
-
-	fig, axs = plt.subplots(7, 2, figsize=(16, 35))
-	fig.tight_layout(pad=5.0)
-
-	printRegionalVolume(data, axs[0][0], 4, 0, 1.4, "Beaufort Sea CryoSat-SMOS ice volume")
-	printRegionalVolume(data, axs[0][1], 5, 0, 1.4, "Chukchi Sea CryoSat-SMOS ice volume")
-	printRegionalVolume(data, axs[1][0], 6, 0, 1.4, "East Siberian Sea CryoSat-SMOS ice volume")
-	printRegionalVolume(data, axs[1][1], 7, 0, 0.7, "Laptev Sea CryoSat-SMOS ice volume")
-	printRegionalVolume(data, axs[2][0], 8, 0, 1.0, "Kara Sea CryoSat-SMOS ice volume")
-	printRegionalVolume(data, axs[2][1], 9, 0, 0.5, "Barents Sea CryoSat-SMOS ice volume")
-	printRegionalVolume(data, axs[3][0], 10, 0, 1.0, "Greenland Sea CryoSat-SMOS ice volume")
-	printRegionalVolume(data, axs[3][1], 11, 3, 11, "Central Arctic Basin CryoSat-SMOS ice volume")
-	printRegionalVolume(data, axs[4][0], 12, 0, 1.6, "Canadian Arctic Archipelago CryoSat-SMOS ice volume")
-	printRegionalVolume(data, axs[4][1], 13, 0, 1.0, "Baffin Bay CryoSat-SMOS ice volume")
-	printRegionalVolume(data, axs[5][0], 14, 0, 1.3, "Hudson Bay CryoSat-SMOS ice volume")
-	printRegionalVolume(data, axs[5][1], 3, 0, 0.5, "Bering Sea CryoSat-SMOS ice volume")
-	printRegionalVolume(data, axs[6][0], 2, 0, 0.35, "Sea of Okhotsk CryoSat-SMOS ice volume")
-	printRegionalVolume(data, axs[6][1], 16, 0, 21, "Total CryoSat-SMOS ice volume")
 	#axs[6][1].axis('off')
 	#axs[4][2].axis('off')
 
 	#fig.show()
 	#wait = input("Press Enter to continue.")
-	dropboxFileName = 'cryosat-smos-regional-volume-7x2.png'
-	fig.savefig(dropboxFileName)
-	if putOnDropbox:
-		dropbox_client.uploadToDropbox([csvFileName, "cryosat-smos-volume-total.png", 'cryosat-smos-thickness-latest.png', 'cryosat-smos-thickness-anomaly-latest.png'])
-		#uploadToDropbox(csvFileName)		
-		#uploadToDropbox(dropboxFileName)
+	saveRegionalFigure(regionalPanels, data, (16, 35), 'cryosat-smos-regional-volume-7x2.png', derived)
 
 
 print('__name__: ',__name__)
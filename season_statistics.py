@@ -0,0 +1,165 @@
+import json
+import os
+import zlib
+from bisect import bisect_left, bisect_right, insort
+import numpy as np
+
+seasonLength = 177          # days per season in the regional volume CSV, as in regional_python_graphs
+firstRowDayOfSeason = 6     # the first CSV row is day 6 of the 2010/11 season
+regionColumns = {           # CSV column of each region, in the order written by dayvol
+	'okhotsk': 2, 'bering': 3, 'beaufort': 4, 'chukchi': 5, 'ess': 6, 'laptev': 7, 'kara': 8, 'barents': 9,
+	'greenland': 10, 'cab': 11, 'caa': 12, 'baffin': 13, 'hudson': 14, 'other': 15, 'total': 16,
+}
+statisticsFileName = 'data/season-statistics.json'
+bandsFileName = 'cryosat-smos-percentile-bands.csv'
+defaultPercentiles = (10, 25, 50, 75, 90)
+
+def getDayOfSeason(rowIndex):
+	"""
+	Season index and day of season (0-based) of a data row of the regional volume CSV.
+    """
+	return divmod(rowIndex + firstRowDayOfSeason, seasonLength)
+
+class SeasonStatistics:
+	"""
+	Sorted volumes of all seasons per (region, day of season), updated incrementally as rows are appended to the CSV.
+	Rank, percentile, minimum and maximum queries are binary searches in these sorted lists.
+    """
+	def __init__(self):
+		self.values = {region: [[] for _ in range(seasonLength)] for region in regionColumns}
+		self.checksums = []    # checksum of every consumed CSV row, to detect rows that were rewritten
+		self.volumes = []      # volumes per region (in regionColumns order) of every consumed CSV row
+		self.latest = None     # (day of season, {region: volume}) of the last consumed row
+
+	def insertRow(self, rowIndex, volumes):
+		_, day = getDayOfSeason(rowIndex)
+		for region, volume in zip(regionColumns, volumes):
+			insort(self.values[region][day], volume)
+
+	def removeRow(self, rowIndex):
+		_, day = getDayOfSeason(rowIndex)
+		for region, volume in zip(regionColumns, self.volumes[rowIndex]):
+			values = self.values[region][day]
+			del values[bisect_left(values, volume)]
+
+	def update(self, csvFileName):
+		"""
+		Consume the rows of the CSV that were appended or changed since the last update: the old volumes of a
+		changed row are removed from the sorted lists and its new volumes inserted. Returns the number of such rows.
+	    """
+		rowIndex = 0
+		changedRows = 0
+		with open(csvFileName, 'r') as f:
+			next(f) # header
+			for line in f:
+				if not line.endswith('\n'):
+					break # incomplete last line, consumed on the next update
+				if not line.strip():
+					continue
+				checksum = zlib.crc32(line.encode('utf-8'))
+				if rowIndex < len(self.checksums) and self.checksums[rowIndex] == checksum:
+					rowIndex += 1
+					continue
+				fields = line.split(',')
+				volumes = [float(fields[col]) for col in regionColumns.values()]
+				if rowIndex < len(self.checksums):
+					self.removeRow(rowIndex)
+					self.checksums[rowIndex], self.volumes[rowIndex] = checksum, volumes
+				else:
+					self.checksums.append(checksum)
+					self.volumes.append(volumes)
+				self.insertRow(rowIndex, volumes)
+				changedRows += 1
+				rowIndex += 1
+		while len(self.checksums) > rowIndex: # rows removed from the end of the CSV
+			self.removeRow(len(self.checksums) - 1)
+			self.checksums.pop()
+			self.volumes.pop()
+			changedRows += 1
+		if self.volumes:
+			self.latest = (getDayOfSeason(len(self.volumes) - 1)[1], dict(zip(regionColumns, self.volumes[-1])))
+		return changedRows
+
+	def getSorted(self, region, day):
+		return self.values[region][day]
+
+	def rank(self, region, day, value):
+		"""
+		Rank of a volume among all seasons for a region and day of season, 1 being the lowest.
+	    """
+		return bisect_left(self.getSorted(region, day), value) + 1
+
+	def percentile(self, region, day, value):
+		"""
+		Percentage of seasons with a volume lower than or equal to value.
+	    """
+		values = self.getSorted(region, day)
+		return 100.0 * bisect_right(values, value) / len(values) if values else float('nan')
+
+	def minimum(self, region, day):
+		values = self.getSorted(region, day)
+		return values[0] if values else float('nan')
+
+	def maximum(self, region, day):
+		values = self.getSorted(region, day)
+		return values[-1] if values else float('nan')
+
+	def count(self, region, day):
+		return len(self.getSorted(region, day))
+
+	def percentileBands(self, region, percentiles = defaultPercentiles):
+		"""
+		Percentile bands for plotting: an array of len(percentiles) x seasonLength, NaN for days without data.
+	    """
+		bands = np.full((len(percentiles), seasonLength), np.nan)
+		for day, values in enumerate(self.values[region]):
+			if values:
+				bands[:, day] = np.percentile(values, percentiles)
+		return bands
+
+	def exportPercentileBands(self, filename = bandsFileName, percentiles = defaultPercentiles):
+		header = ['day'] + [region + '_p' + str(p) for region in regionColumns for p in percentiles]
+		bands = np.vstack([self.percentileBands(region, percentiles) for region in regionColumns])
+		table = np.column_stack((np.arange(1, seasonLength + 1), bands.T))
+		np.savetxt(filename, table, delimiter=',', header=','.join(header), comments='', fmt=['%d'] + ['%.2f'] * bands.shape[0])
+
+	def describeLatest(self):
+		"""
+		Print the rank of the latest day's volume among all seasons for every region.
+	    """
+		if self.latest is None:
+			return
+		day, volumes = self.latest
+		for region, volume in volumes.items():
+			print('{}: {} km³, rank {} of {} (1 = lowest), percentile {:.0f}'.format(region, volume,
+				self.rank(region, day, volume), self.count(region, day), self.percentile(region, day, volume)))
+
+	def save(self, filename = statisticsFileName):
+		os.makedirs(os.path.dirname(filename), exist_ok=True)
+		with open(filename + '.tmp', 'w') as f:
+			json.dump({'checksums': self.checksums, 'volumes': self.volumes, 'latest': self.latest, 'values': self.values}, f)
+		os.replace(filename + '.tmp', filename)
+
+def loadStatistics(filename = statisticsFileName):
+	statistics = SeasonStatistics()
+	if os.path.isfile(filename):
+		with open(filename, 'r') as f:
+			saved = json.load(f)
+		if set(saved['values']) != set(regionColumns) or 'checksums' not in saved:
+			return statistics # regions or file format changed, rebuild from the CSV
+		statistics.checksums = saved['checksums']
+		statistics.volumes = saved['volumes']
+		statistics.latest = saved['latest']
+		statistics.values = saved['values']
+	return statistics
+
+def updateStatistics(csvFileName, filename = statisticsFileName):
+	"""
+	Load the saved statistics, consume the new CSV rows, save them again and export the percentile bands.
+    """
+	statistics = loadStatistics(filename)
+	print('season statistics: new or changed rows', statistics.update(csvFileName))
+	statistics.save(filename)
+	statistics.exportPercentileBands()
+	statistics.describeLatest()
+	return statistics
@@ -0,0 +1,142 @@
+import hashlib
+import json
+import os
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+class Task:
+	def __init__(self, name, action, inputs, outputs, after, key):
+		self.name = name
+		self.action = action
+		self.inputs = list(inputs)
+		self.outputs = list(outputs)
+		self.after = set(after)
+		self.key = key
+
+class TaskGraph:
+	"""
+	Runs a set of tasks that each declare their input and output files.
+	A task is skipped when the content hash of its inputs (and its key) is unchanged since its last
+	successful run and all its outputs still exist. Tasks whose dependencies are done run concurrently.
+	onDone, if given, is called with every task that was built or skipped, as soon as it is done.
+    """
+	def __init__(self, stateFileName = 'task-state.json', maxWorkers = 4, onDone = None):
+		self.stateFileName = stateFileName
+		self.maxWorkers = maxWorkers
+		self.onDone = onDone
+		self.tasks = {}
+		self.state = {}
+		if os.path.isfile(stateFileName):
+			with open(stateFileName, 'r') as f:
+				self.state = json.load(f)
+		self.stateLock = threading.Lock()
+		self.fileHashes = {}
+
+	def addTask(self, name, action, inputs = (), outputs = (), after = (), key = ''):
+		"""
+		Add a task. Tasks producing one of its inputs are added as dependencies automatically.
+	    """
+		if name in self.tasks:
+			raise ValueError('duplicate task ' + name)
+		self.tasks[name] = Task(name, action, inputs, outputs, after, str(key))
+
+	def getFileHash(self, path):
+		if not os.path.isfile(path):
+			return 'missing'
+		stat = os.stat(path)
+		cacheKey = (path, stat.st_mtime_ns, stat.st_size)
+		with self.stateLock:
+			if cacheKey in self.fileHashes:
+				return self.fileHashes[cacheKey]
+		digest = hashlib.md5()
+		with open(path, 'rb') as f:
+			for chunk in iter(lambda: f.read(1 << 20), b''):
+				digest.update(chunk)
+		with self.stateLock:
+			self.fileHashes[cacheKey] = digest.hexdigest()
+		return self.fileHashes[cacheKey]
+
+	def getInputHash(self, task):
+		digest = hashlib.md5(task.key.encode('utf-8'))
+		for path in task.inputs:
+			digest.update(path.encode('utf-8'))
+			digest.update(self.getFileHash(path).encode('utf-8'))
+		return digest.hexdigest()
+
+	def getDependencies(self):
+		producers = {}
+		for task in self.tasks.values():
+			for path in task.outputs:
+				producers[path] = task.name
+		dependencies = {}
+		for task in self.tasks.values():
+			dependencies[task.name] = set(task.after)
+			for path in task.inputs:
+				if path in producers and producers[path] != task.name:
+					dependencies[task.name].add(producers[path])
+			unknown = dependencies[task.name] - set(self.tasks)
+			if unknown:
+				raise ValueError('task ' + task.name + ' depends on unknown tasks ' + str(sorted(unknown)))
+		return dependencies
+
+	def saveState(self):
+		with open(self.stateFileName + '.tmp', 'w') as f:
+			json.dump(self.state, f, indent=1, sort_keys=True)
+		os.replace(self.stateFileName + '.tmp', self.stateFileName)
+
+	def runTask(self, task):
+		inputHash = self.getInputHash(task)
+		if self.state.get(task.name) == inputHash and all(os.path.isfile(path) for path in task.outputs):
+			print('[SKIPPED] {}'.format(task.name))
+			if self.onDone:
+				self.onDone(task)
+			return 'skipped'
+		print('[RUNNING] {}'.format(task.name))
+		task.action()
+		inputHash = self.getInputHash(task) # inputs may only have been downloaded by the task itself
+		with self.stateLock:
+			self.state[task.name] = inputHash
+			self.saveState()
+		print('[DONE] {}'.format(task.name))
+		if self.onDone:
+			self.onDone(task)
+		return 'built'
+
+	def run(self):
+		"""
+		Run all tasks in dependency order and return a dictionary with the outcome of each task:
+		'built', 'skipped', 'failed' or 'blocked' (a dependency failed).
+	    """
+		dependencies = self.getDependencies()
+		results = {}
+		pending = set(self.tasks)
+		running = {}
+		with ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+			while pending or running:
+				progress = True
+				while progress:
+					progress = False
+					for name in sorted(pending):
+						if any(results.get(dependency) in ('failed', 'blocked') for dependency in dependencies[name]):
+							results[name] = 'blocked'
+							print('[BLOCKED] {}'.format(name))
+						elif all(dependency in results for dependency in dependencies[name]):
+							running[executor.submit(self.runTask, self.tasks[name])] = name
+						else:
+							continue
+						pending.remove(name)
+						progress = True
+				if not running:
+					if pending:
+						raise ValueError('dependency cycle between tasks ' + str(sorted(pending)))
+					break
+				done, _ = wait(running, return_when=FIRST_COMPLETED)
+				for future in done:
+					name = running.pop(future)
+					try:
+						results[name] = future.result()
+					except Exception as e:
+						print('[FAILED] {}: {}\n{}'.format(name, e, traceback.format_exc()))
+						results[name] = 'failed'
+		return results
@@ -0,0 +1,87 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+class UploadQueue:
+	"""
+	Uploads artifacts in the background as soon as they are submitted, with a bounded number of concurrent
+	uploads per target (Dropbox, Google Drive) and retries with exponential backoff.
+	Content that was already uploaded to the same destination (in this run or a previous one) is not uploaded again.
+    """
+	def __init__(self, limits = {'dropbox': 2, 'google-drive': 2}, maxWorkers = 4, retries = 3, backoff = 2.0, stateFileName = 'upload-state.json'):
+		self.limits = {target: threading.Semaphore(limit) for target, limit in limits.items()}
+		self.maxWorkers = maxWorkers
+		self.retries = retries
+		self.backoff = backoff
+		self.stateFileName = stateFileName
+		self.state = {}
+		if os.path.isfile(stateFileName):
+			with open(stateFileName, 'r') as f:
+				self.state = json.load(f)
+		self.lock = threading.Lock()
+		self.executor = None
+		self.futures = []
+		self.submitted = {}  # destination key -> content hash, of uploads submitted in this run
+		self.report = {}
+
+	def submit(self, target, path, upload, destination = None):
+		"""
+		Queue upload(path) to a target. destination identifies the remote file and defaults to the path.
+	    """
+		key = target + ':' + (destination or path)
+		if not os.path.isfile(path):
+			print('[UPLOAD FAILED] {}: missing file {}'.format(key, path))
+			with self.lock:
+				self.report[key] = 'failed: missing file'
+			return
+		with open(path, 'rb') as f:
+			contentHash = hashlib.md5(f.read()).hexdigest()
+		with self.lock:
+			if contentHash in (self.submitted.get(key), self.state.get(key)):
+				self.report.setdefault(key, 'unchanged')
+				return
+			self.submitted[key] = contentHash
+			if self.executor is None:
+				self.executor = ThreadPoolExecutor(max_workers=self.maxWorkers)
+			self.futures.append(self.executor.submit(self.run, target, key, path, upload, contentHash))
+
+	def run(self, target, key, path, upload, contentHash):
+		with self.limits.get(target, threading.Semaphore(1)):
+			for attempt in range(self.retries + 1):
+				try:
+					upload(path)
+					break
+				except Exception as e:
+					if attempt == self.retries:
+						print('[UPLOAD FAILED] {}: {}'.format(key, e))
+						with self.lock:
+							self.report[key] = 'failed: ' + str(e)
+							if self.submitted.get(key) == contentHash:
+								del self.submitted[key] # allow a later submit to try again
+						return
+					delay = self.backoff * 2**attempt
+					print('[UPLOAD RETRY] {} in {}s: {}'.format(key, delay, e))
+					time.sleep(delay)
+		with self.lock:
+			self.state[key] = contentHash
+			self.report[key] = 'uploaded'
+
+	def flush(self):
+		"""
+		Wait for all queued uploads, save the uploaded content hashes and print and return the outcome per destination:
+		'uploaded', 'unchanged' or 'failed: <reason>'.
+	    """
+		with self.lock:
+			futures, self.futures = self.futures, []
+		wait(futures)
+		with self.lock:
+			with open(self.stateFileName + '.tmp', 'w') as f:
+				json.dump(self.state, f, indent=1, sort_keys=True)
+			os.replace(self.stateFileName + '.tmp', self.stateFileName)
+			report = dict(self.report)
+		for key in sorted(report):
+			print('[UPLOAD] {}: {}'.format(key, report[key]))
+		return report
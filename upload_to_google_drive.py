@@ -3,10 +3,17 @@ from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
 import os
 import os.path
+import threading
 from googleapiclient.http import MediaFileUpload
 from decouple import config
 
+credentials_lock = threading.Lock() # uploads run concurrently, but token.json is written in place
+
 def get_credentials(SCOPES):
+	with credentials_lock:
+		return read_credentials(SCOPES)
+
+def read_credentials(SCOPES):
 	creds = None
 	credentials_filename = "token.json"
 	if not os.path.exists(credentials_filename):